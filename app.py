@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, send_from_directory, url_for
+from flask import Flask, Response, render_template, request, send_from_directory, stream_with_context, url_for
 from file_handler import FileHandler
 import json
 
@@ -13,23 +13,80 @@ def index():
 
 @app.route('/asr', methods=['POST'])
 def asr():
+    return json.dumps({'r': format_responses(FileHandler.get_recognized_texts(get_blobs()))}, ensure_ascii=False)
+
+
+@app.route('/asr/jobs', methods=['POST'])
+def asr_jobs():
+    job_id = FileHandler.submit_job(get_blobs())
+    if job_id is None:
+        return Response(json.dumps({'error': 'Too many jobs, try again later'}), status=429,
+                        mimetype='application/json', headers={'Retry-After': '5'})
+
+    return Response(json.dumps({'job_id': job_id}), status=202, mimetype='application/json',
+                    headers={'Location': url_for('asr_job', job_id=job_id)})
+
+
+@app.route('/asr/jobs/<job_id>', methods=['GET'])
+def asr_job(job_id):
+    # The wait parameter makes the request wait up to that many seconds for the job to finish
+    state = FileHandler.get_job(job_id, min(max(request.args.get('wait', 0, type=float), 0), 60))
+    if state is None:
+        return Response(json.dumps({'error': 'Unknown job'}), status=404, mimetype='application/json')
+
+    response = {'job_id': state['job_id'], 'status': state['status']}
+    if state['status'] == 'done':
+        response['r'] = format_responses(state['result'])
+    elif state['status'] == 'error':
+        response['error'] = state['result']
+
+    return Response(json.dumps(response, ensure_ascii=False), mimetype='application/json')
+
+
+def get_blobs():
+    return [
+        request.files[f] for f in request.files
+        if f.startswith('audio_blob') and FileHandler.check_format(request.files[f])
+    ]
+
+
+def format_responses(responses):
     res = []
-    for f in request.files:
-        if f.startswith('audio_blob') and FileHandler.check_format(request.files[f]):
-
-            response_code, filename, response = FileHandler.get_recognized_text(request.files[f])
-
-            if response_code == 0:
-                response_audio_url = url_for('media_file', filename=filename)
-            else:
-                response_audio_url = None
-
-            res.append({
-                'response_audio_url': response_audio_url,
-                'response_code': response_code,
-                'response': response,
-            })
-    return json.dumps({'r': res}, ensure_ascii=False)
+
+    for response_code, filename, response in responses:
+        if response_code == 0 and filename is not None:
+            response_audio_url = url_for('media_file', filename=filename)
+        else:
+            response_audio_url = None
+
+        res.append({
+            'response_audio_url': response_audio_url,
+            'response_code': response_code,
+            'response': response,
+        })
+    return res
+
+
+@app.route('/asr/stream', methods=['POST'])
+def asr_stream():
+    # Request body is raw 16 kHz mono s16le PCM, partial results are sent back as JSON lines
+    def generate():
+        chunks = iter(lambda: request.stream.read(32000), b'')
+        for result in FileHandler.get_stream_results(chunks):
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    status = FileHandler.get_models_status()
+    return Response(json.dumps(status), status=200 if status['ready'] else 503, mimetype='application/json')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(FileHandler.render_metrics(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/media/<path:filename>', methods=['GET'])
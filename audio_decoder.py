@@ -0,0 +1,63 @@
+import io
+import subprocess
+import tempfile
+import threading
+import wave
+import numpy as np
+
+
+class AudioDecoder(object):
+    def __init__(self, sample_rate=16000, workers=4):
+        self.sample_rate = sample_rate
+        self.workers = threading.BoundedSemaphore(workers)
+
+    def decode(self, data):
+        if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+            audio = self.decode_wav(data)
+            if audio is not None:
+                return audio
+
+        return self.decode_ffmpeg(data)
+
+    def decode_wav(self, data):
+        # Only WAV files that already match the acoustic model format are read in-process,
+        # everything else is resampled by ffmpeg as before
+        try:
+            with wave.open(io.BytesIO(data), 'rb') as wav:
+                if wav.getsampwidth() != 2 or wav.getnchannels() != 1 or wav.getframerate() != self.sample_rate:
+                    return None
+                frames = wav.readframes(wav.getnframes())
+        except (wave.Error, EOFError):
+            return None
+
+        return np.frombuffer(frames, dtype='<i2').astype(np.int16, copy=False)
+
+    def decode_ffmpeg(self, data):
+        command = [
+            'ffmpeg', '-loglevel', 'error', '-i', 'pipe:0',
+            '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(self.sample_rate), 'pipe:1'
+        ]
+
+        with self.workers:
+            process = subprocess.run(command, input=data, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+            if process.returncode != 0 or len(process.stdout) == 0:
+                # Containers with the index at the end of the file (mp4, mov, m4a) can't be read from a pipe
+                with tempfile.NamedTemporaryFile() as f:
+                    f.write(data)
+                    f.flush()
+                    command[command.index('pipe:0')] = f.name
+                    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        if process.returncode != 0 or len(process.stdout) == 0:
+            raise Exception('Could not decode audio file')
+
+        return np.frombuffer(process.stdout, dtype='<i2').astype(np.int16, copy=False)
+
+
+def save_wav(path, audio, sample_rate=16000):
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(audio.astype('<i2', copy=False).tobytes())
@@ -0,0 +1,108 @@
+import time
+import logging
+import threading
+import collections
+from concurrent.futures import Future, as_completed
+import metrics
+
+
+queue_depth = metrics.gauge('asr_scheduler_queue_depth', 'Utterances waiting for the acoustic model')
+batch_size = metrics.histogram('asr_scheduler_batch_size', 'Utterances in one acoustic model forward pass',
+                               buckets=metrics.SIZE_BUCKETS)
+wait_time = metrics.histogram('asr_scheduler_wait_seconds', 'Time an utterance waits in the scheduler queue')
+
+
+class ScheduledRequest(object):
+    def __init__(self, spectrogram):
+        self.spectrogram = spectrogram
+        self.future = Future()
+        self.time = time.time()
+        self.start_time, self.end_time = None, None
+
+
+class BatchScheduler(object):
+    def __init__(self, recognizer, max_batch_size=16, max_wait=0.01):
+        self.recognizer = recognizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self.run, name='batch-scheduler', daemon=True)
+        self.thread.start()
+
+    def forward(self, spectrograms):
+        # Same as SpeechRecognizer.forward_buckets, outputs are yielded in the order their batches finish
+        # and utterances are batched with the ones of concurrent requests
+        requests = [self.submit(spectrogram) for spectrogram in spectrograms]
+        indices = {request.future: j for j, request in enumerate(requests)}
+
+        for future in as_completed(indices):
+            j = indices[future]
+            error = future.exception()
+            yield j, future.result() if error is None else error, requests[j].start_time, requests[j].end_time
+
+    def submit(self, spectrogram):
+        request = ScheduledRequest(spectrogram)
+
+        with self.condition:
+            self.queue.append(request)
+            queue_depth.set(len(self.queue))
+            self.condition.notify()
+
+        return request
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0:
+                    self.condition.wait()
+
+                deadline = self.queue[0].time + self.max_wait
+                while len(self.queue) < self.max_batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                requests = list(self.queue)
+                self.queue.clear()
+                queue_depth.set(0)
+
+            self.process(requests)
+
+    def process(self, requests):
+        now = time.time()
+        for request in requests:
+            wait_time.observe(now - request.time)
+
+        for bucket in self.recognizer.get_buckets([request.spectrogram.shape[1] for request in requests]):
+            batch = [requests[i] for i in bucket]
+            batch_size.observe(len(batch))
+
+            now = time.time()
+            for request in batch:
+                request.start_time = now
+
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        try:
+            outputs = self.recognizer.forward([request.spectrogram for request in batch])
+        except Exception as e:
+            logging.exception(e)
+
+            # Requests of a failed batch are retried one by one, so that a bad utterance fails only its own request
+            if len(batch) == 1:
+                batch[0].end_time = time.time()
+                batch[0].future.set_exception(e)
+            else:
+                for request in batch:
+                    self.run_batch([request])
+            return
+
+        now = time.time()
+        for request, output in zip(batch, outputs):
+            request.end_time = now
+            request.future.set_result(output)
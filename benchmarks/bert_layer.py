@@ -0,0 +1,152 @@
+import argparse
+import math
+import time
+import types
+import numpy as np
+
+
+# PuzzleLib is imported after the backend is chosen in main, the bert_punctuator versions of the modules
+# use the same kernels as PuzzleLib and fall back to numpy on the CPU backend
+
+def reference_layer_norm(self, data):
+    # Builds the normalization and tiling modules on every call, as before the modules were cached
+    from PuzzleLib.Backend.Kernels import MatVec
+    from PuzzleLib.Modules import Tile
+    from bert_punctuator.modules import InstanceNorm2D
+
+    batchsize, maps, h = data.shape
+
+    data = data.reshape((batchsize, maps, h, 1))
+    norm = InstanceNorm2D(maps, epsilon=self.epsilon)
+    norm.calcMode(self.calctype)
+    data = norm(data)
+    data = data.reshape((batchsize * maps, h))
+
+    tile = Tile(axis=0, times=data.shape[0])
+    tile.calcMode(self.calctype)
+    scale = tile(self.scale.reshape(tuple([1]) + self.scale.shape))
+
+    data = self.mul([data, scale])
+    MatVec.addVecToMat(self.bias, data, axis=1, out=data)
+    self.data = data.reshape(batchsize, maps, h)
+
+
+def reference_self_attention(self, hiddenStates):
+    # Swaps keys explicitly and scales scores with a full-size tensor, as before the modules were cached
+    from PuzzleLib.Backend import gpuarray
+    from PuzzleLib.Modules import Mul, SwapAxes
+    from bert_punctuator.modules import SoftMax, mulTensorBatch
+
+    def transpose(x):
+        x = x.reshape(x.shape[:-1] + (self.num_attention_heads, self.attentionHeadSize))
+        swap = SwapAxes(axis1=1, axis2=2)
+        swap.calcMode(self.calctype)
+        return swap(x)
+
+    queryLayer = transpose(self.modules['query'](hiddenStates))
+    keyLayer = transpose(self.modules['key'](hiddenStates))
+    valueLayer = transpose(self.modules['value'](hiddenStates))
+
+    batchsize, maps, h, w = queryLayer.shape
+
+    swap = SwapAxes(axis1=2, axis2=1)
+    swap.calcMode(self.calctype)
+
+    A = queryLayer.reshape((batchsize * maps, h, w))
+    B = swap(keyLayer.reshape((batchsize * maps, h, w)))
+    attentionScores = mulTensorBatch(A, B, formatA="gbp", formatB="gbp", formatOut="gbp")
+    attentionScores = attentionScores.reshape((batchsize, maps, h, h))
+
+    a = gpuarray.empty(attentionScores.shape, self.calctype)
+    a.fill(1 / math.sqrt(self.attentionHeadSize))
+    mul = Mul()
+    mul.calcMode(self.calctype)
+    attentionScores = mul([attentionScores, a])
+
+    softmax = SoftMax()
+    softmax.calcMode(self.calctype)
+    swap2 = SwapAxes(axis1=1, axis2=3)
+    swap2.calcMode(self.calctype)
+    attentionProbs = swap2(softmax(swap2(attentionScores)))
+
+    contextLayer = mulTensorBatch(attentionProbs.reshape((batchsize * maps, h, h)),
+                                  valueLayer.reshape((batchsize * maps, h, w)),
+                                  formatA="gbp", formatB="gbp", formatOut="gbp")
+
+    self.data = swap(contextLayer.reshape((batchsize, maps, h, w))).reshape((batchsize, h, self.allHeadSize))
+
+
+def iterate_modules(module):
+    yield module
+    for child in getattr(module, 'modules', {}).values():
+        yield from iterate_modules(child)
+
+
+def use_reference(layer, reference):
+    from bert_punctuator.bert import BertLayerNorm, BertSelfAttention
+    implementations = {BertLayerNorm: reference_layer_norm, BertSelfAttention: reference_self_attention}
+
+    for module in iterate_modules(layer):
+        implementation = implementations.get(type(module))
+        if implementation is None:
+            continue
+
+        if reference:
+            module.updateData = types.MethodType(implementation, module)
+        else:
+            vars(module).pop('updateData', None)
+
+
+def measure(layer, data, iterations):
+    for _ in range(3):
+        layer(data)
+    layer(data).get()
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        output = layer(data)
+    output.get()
+
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BertLayer forward benchmark')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 64], help='Batch sizes')
+    parser.add_argument('--iterations', type=int, default=100, help='Forward passes per measurement')
+    parser.add_argument('--cpu', action='store_true', help='Run on the CPU backend in float32')
+    args = parser.parse_args()
+
+    if args.cpu:
+        from cpu_backend import setup_cpu_backend
+        setup_cpu_backend()
+
+    from PuzzleLib.Backend import gpuarray
+    from bert_punctuator.bert import BertConfig, BertLayer
+
+    dtype = np.float32 if args.cpu else np.float16
+    config = BertConfig(1000)
+    layer = BertLayer(config)
+    layer.evalMode()
+    layer.calcMode(dtype)
+
+    for batchsize in args.batch_sizes:
+        data = gpuarray.to_gpu(
+            np.random.randn(batchsize, config.segment_size, config.hidden_size).astype(dtype)
+        )
+        outputs = {}
+
+        for implementation in ('reference', 'bert_layer'):
+            use_reference(layer, implementation == 'reference')
+            elapsed = measure(layer, data, args.iterations)
+            outputs[implementation] = layer(data).get().astype(np.float32)
+
+            print('{:>10} batch {:3d}: {:8.3f} ms per forward pass'.format(implementation, batchsize, elapsed * 1000))
+
+        print('Max abs difference from reference output: {:.2e}'.format(
+            np.abs(outputs['reference'] - outputs['bert_layer']).max()
+        ))
+
+
+if __name__ == '__main__':
+    main()
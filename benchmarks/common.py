@@ -0,0 +1,48 @@
+import resource
+import numpy as np
+
+
+WORDS = [
+    'привет', 'как', 'дела', 'сегодня', 'хорошая', 'погода', 'я', 'иду', 'в', 'магазин', 'купить', 'хлеба',
+    'и', 'молока', 'завтра', 'будет', 'встреча', 'с', 'клиентом', 'по', 'поводу', 'договора', 'нужно',
+    'подготовить', 'документы', 'позвоните', 'мне', 'пожалуйста', 'когда', 'освободитесь'
+]
+
+NUMBER_WORDS = ['два', 'двадцать', 'пять', 'сто', 'тысяча', 'три', 'целых', 'десятых', 'минус']
+
+
+def synthetic_audio(minutes, sample_rate=16000, seed=0):
+    rng = np.random.RandomState(seed)
+    audio = np.empty(int(minutes * 60 * sample_rate), dtype=np.int16)
+
+    # Generated second by second so that the input itself does not dominate peak memory
+    for start in range(0, len(audio), sample_rate):
+        t = np.arange(start, min(start + sample_rate, len(audio))) / sample_rate
+        block = 3000 * np.sin(2 * np.pi * 220 * t) * (1 + np.sin(2 * np.pi * 0.5 * t)) + 300 * rng.randn(len(t))
+        audio[start:start + len(t)] = block
+
+    return audio
+
+
+def synthetic_text(words, number_ratio=0.1, seed=0):
+    rng = np.random.RandomState(seed)
+    return ' '.join(
+        NUMBER_WORDS[rng.randint(len(NUMBER_WORDS))] if rng.rand() < number_ratio else WORDS[rng.randint(len(WORDS))]
+        for _ in range(words)
+    )
+
+
+def synthetic_posteriors(frames, labels_count, blank_idx=0, seed=0):
+    # Log-probabilities of a path that alternates short letter runs with blanks
+    rng = np.random.RandomState(seed)
+    output = rng.randn(frames, labels_count).astype(np.float32)
+    path = np.where(rng.rand(frames) < 0.6, blank_idx, rng.randint(1, labels_count, frames))
+    output[np.arange(frames), path] += 8.0
+    output -= np.log(np.exp(output).sum(axis=1, keepdims=True))
+
+    return output
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
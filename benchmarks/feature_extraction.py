@@ -0,0 +1,84 @@
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import scipy.signal
+from benchmarks.common import rss_mb, synthetic_audio
+from data_loader import preprocess
+from utils import stft, magphase
+
+
+def reference_preprocess(audio, sample_rate=16000, window_size=0.02, window_stride=0.01, window='hamming'):
+    # Float64 path with a full complex FFT and phase computation, as used before the float32 rewrite
+    audio = np.asarray(audio).astype(float)
+    nfft = int(sample_rate * window_size)
+    hop_length = int(sample_rate * window_stride)
+
+    d = stft(audio, n_fft=nfft, hop_length=hop_length, win_length=nfft, window=window)
+    spect, phase = magphase(d)
+
+    s = 1 - np.exp(-float(hop_length) / (0.395 * sample_rate))
+    m = scipy.signal.lfilter([s], [1, s - 1], spect)
+    pcen_result = (spect * (0.000001 + m) ** (-0.98) + 2.0) ** 0.5 - 2.0 ** 0.5
+
+    return (pcen_result - pcen_result.mean()) / pcen_result.std()
+
+
+IMPLEMENTATIONS = {
+    'reference': reference_preprocess,
+    'preprocess': preprocess
+}
+
+
+def run_child(implementation, minutes):
+    audio = synthetic_audio(minutes)
+    baseline = rss_mb()
+
+    start = time.perf_counter()
+    features = IMPLEMENTATIONS[implementation](audio)
+    elapsed = time.perf_counter() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({
+        'implementation': implementation,
+        'minutes': minutes,
+        'seconds_per_audio_minute': elapsed / minutes,
+        'peak_rss_mb': peak,
+        'peak_rss_increase_mb': peak - baseline,
+        'checksum': float(np.abs(features).sum())
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Feature extraction benchmark')
+    parser.add_argument('--minutes', type=float, nargs='+', default=[1, 5, 15], help='Audio lengths in minutes')
+    parser.add_argument('--child', nargs=2, metavar=('IMPLEMENTATION', 'MINUTES'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_child(args.child[0], float(args.child[1]))
+        return
+
+    # Every measurement runs in a fresh process so that peak RSS is not shared between runs
+    for minutes in args.minutes:
+        for implementation in IMPLEMENTATIONS:
+            output = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.feature_extraction', '--child', implementation, str(minutes)
+            ])
+            result = json.loads(output)
+            print('{:>10} {:6.1f} min: {:7.3f} s per audio minute, peak RSS {:8.1f} MB (+{:.1f} MB)'.format(
+                implementation, minutes, result['seconds_per_audio_minute'], result['peak_rss_mb'],
+                result['peak_rss_increase_mb']
+            ))
+
+    audio = synthetic_audio(min(args.minutes))
+    print('Max abs difference from reference features: {:.2e}'.format(
+        np.abs(reference_preprocess(audio) - preprocess(audio)).max()
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+import argparse
+import configparser
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from benchmarks.common import rss_mb, synthetic_audio, synthetic_posteriors, synthetic_text
+
+
+AUDIO_STAGES = ['load_audio', 'preprocess', 'stft', 'pcen2', 'w2l_forward', 'greedy_decode', 'trie_decode']
+TEXT_STAGES = ['punctuate', 'tokenize', 'text2numbers']
+
+
+class StageInputs(object):
+    # Every method builds the models and synthetic inputs of one stage and returns the function to time
+    def __init__(self, config_path):
+        self.config_path = config_path
+        self.config = configparser.ConfigParser()
+        self.config.read(config_path, encoding='UTF-8')
+
+        self.labels = self.config['Wav2Letter']['labels'][1:-1]
+        self.sample_rate = int(self.config['Wav2Letter']['sample_rate'])
+        self.window_size = float(self.config['Wav2Letter']['window_size'])
+        self.window_stride = float(self.config['Wav2Letter']['window_stride'])
+        self.nfft = int(self.sample_rate * self.window_size)
+        self.hop_length = int(self.sample_rate * self.window_stride)
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def audio(self, seconds):
+        return synthetic_audio(seconds / 60, self.sample_rate).astype(np.float32)
+
+    def frames(self, seconds):
+        # Acoustic model output frames are twice as long as the feature frames
+        return int(seconds / (2 * self.window_stride))
+
+    def load_audio(self, seconds):
+        from audio_decoder import save_wav
+        from data_loader import load_audio
+
+        path = os.path.join(self.tmpdir.name, 'audio.wav')
+        save_wav(path, synthetic_audio(seconds / 60, self.sample_rate), self.sample_rate)
+
+        return lambda: load_audio(path, self.sample_rate)
+
+    def preprocess(self, seconds):
+        from data_loader import preprocess
+
+        audio = self.audio(seconds)
+        return lambda: preprocess(audio, self.sample_rate, self.window_size, self.window_stride)
+
+    def stft(self, seconds):
+        from utils import stft_magnitude
+
+        audio = self.audio(seconds)
+        return lambda: stft_magnitude(audio, n_fft=self.nfft, hop_length=self.hop_length, win_length=self.nfft,
+                                      window='hamming')
+
+    def pcen2(self, seconds):
+        from data_loader import pcen2
+        from utils import stft_magnitude
+
+        spect = stft_magnitude(self.audio(seconds), n_fft=self.nfft, hop_length=self.hop_length,
+                               win_length=self.nfft, window='hamming')
+        return lambda: pcen2(spect, sr=self.sample_rate, hop_length=self.hop_length)
+
+    def w2l_forward(self, seconds):
+        from data_loader import preprocess
+        from speech_recognizer import SpeechRecognizer
+
+        # The acoustic model runs on the CPU backend with the greedy decoder so that no GPU or LM is needed
+        config = configparser.ConfigParser()
+        config.read(self.config_path, encoding='UTF-8')
+        config['Wav2Letter']['cpu'] = '1'
+        config['Wav2Letter']['greedy'] = '1'
+
+        config_path = os.path.join(self.tmpdir.name, 'config.ini')
+        with open(config_path, 'w', encoding='UTF-8') as f:
+            config.write(f)
+
+        recognizer = SpeechRecognizer(config_path)
+        spectrogram = preprocess(self.audio(seconds), self.sample_rate, self.window_size, self.window_stride)
+
+        return lambda: recognizer.forward([spectrogram])
+
+    def greedy_decode(self, seconds):
+        from decoder import GreedyDecoder
+
+        decoder = GreedyDecoder(self.labels)
+        output = synthetic_posteriors(self.frames(seconds), len(self.labels))
+
+        return lambda: decoder.decode(output)
+
+    def trie_decode(self, seconds):
+        from decoder import TrieDecoder
+
+        config = self.config['Wav2Letter']
+        decoder = TrieDecoder(config['lexicon'], config['tokens'], config['lm_path'], float(config['beam_threshold']),
+                              config.get('trie_cache', ''))
+        output = synthetic_posteriors(self.frames(seconds), decoder.tokenDict.index_size(), decoder.blank_idx)
+
+        return lambda: decoder.decode(output)
+
+    def punctuate(self, words):
+        from punctuator import Punctuator
+
+        config = self.config['Punctuator']
+        punctuator = Punctuator(config.get('model_path', 'data/punctuator'), int(config.get('batch_size', 64)))
+        text = synthetic_text(words, number_ratio=0)
+
+        return lambda: punctuator.predict(text)
+
+    def tokenize(self, words):
+        from bert_punctuator.tokenizer import BertTokenizer
+
+        tokenizer = BertTokenizer(os.path.join(self.config['Punctuator'].get('model_path', 'data/punctuator'),
+                                               'vocab.txt'))
+        text = synthetic_text(words, number_ratio=0)
+
+        return lambda: tokenizer.tokenize(text)
+
+    def text2numbers(self, words):
+        from number_utils.text2numbers import TextToNumbers
+
+        text2numbers = TextToNumbers()
+        text = synthetic_text(words)
+
+        return lambda: text2numbers.convert(text)
+
+
+def run_child(config_path, stage, size, repeats):
+    try:
+        run = getattr(StageInputs(config_path), stage)(size)
+    except Exception as e:
+        print(json.dumps({'stage': stage, 'size': size, 'skipped': '{}: {}'.format(type(e).__name__, e)}))
+        return
+
+    baseline = rss_mb()
+    run()
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - start)
+
+    # Python allocations are traced in a separate run so that tracing does not slow down the timed ones
+    tracemalloc.start()
+    run()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({
+        'stage': stage,
+        'size': size,
+        'unit': 'words' if stage in TEXT_STAGES else 'audio_seconds',
+        'repeats': repeats,
+        'p50_ms': float(np.percentile(latencies, 50)) * 1000,
+        'p99_ms': float(np.percentile(latencies, 99)) * 1000,
+        'mean_ms': float(np.mean(latencies)) * 1000,
+        'throughput': size / float(np.mean(latencies)),
+        'traced_peak_mb': traced_peak / 2 ** 20,
+        'peak_rss_mb': peak,
+        'peak_rss_increase_mb': peak - baseline
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pipeline stage benchmarks')
+    parser.add_argument('--config', default='config.ini', help='Path to config')
+    parser.add_argument('--stages', nargs='+', choices=AUDIO_STAGES + TEXT_STAGES, default=AUDIO_STAGES + TEXT_STAGES,
+                        help='Stages to run')
+    parser.add_argument('--audio-seconds', type=float, nargs='+', default=[5, 30, 120], help='Audio lengths')
+    parser.add_argument('--text-words', type=int, nargs='+', default=[10, 100, 1000], help='Text lengths in words')
+    parser.add_argument('--repeats', type=int, default=20, help='Timed runs per measurement')
+    parser.add_argument('--output', default=None, help='Path to save JSON results')
+    parser.add_argument('--child', nargs=2, metavar=('STAGE', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_child(args.config, args.child[0], float(args.child[1]) if args.child[0] in AUDIO_STAGES
+                  else int(args.child[1]), args.repeats)
+        return
+
+    results = []
+
+    # Every measurement runs in a fresh process so that models, backends and peak RSS are not shared
+    for stage in args.stages:
+        for size in args.audio_seconds if stage in AUDIO_STAGES else args.text_words:
+            output = subprocess.check_output([
+                sys.executable, '-m', 'benchmarks.stages', '--config', args.config, '--repeats', str(args.repeats),
+                '--child', stage, str(size)
+            ])
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            results.append(result)
+
+            if 'skipped' in result:
+                print('{:>14} {:>7}: skipped ({})'.format(stage, size, result['skipped']))
+                continue
+
+            print('{:>14} {:>7} {:<13}: p50 {:9.3f} ms, p99 {:9.3f} ms, {:10.1f} {}/s, '
+                  'traced peak {:7.1f} MB, RSS +{:.1f} MB'.format(
+                      stage, size, result['unit'], result['p50_ms'], result['p99_ms'], result['throughput'],
+                      result['unit'], result['traced_peak_mb'], result['peak_rss_increase_mb']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'cpu_count': os.cpu_count(),
+                'results': results
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,24 @@
 import copy
 import json
 import math
+from collections import OrderedDict
 import numpy as np
-from bert_punctuator.modules import Embedder, Linear
-from PuzzleLib.Backend.Blas import mulTensorBatch
+from bert_punctuator.modules import Embedder, Linear, SoftMax, Gelu, InstanceNorm2D, mulTensorBatch
 from PuzzleLib.Backend import gpuarray
-from PuzzleLib.Modules import Module, Activation, SwapAxes, Mul, SoftMax, ModuleError, Tile, Gelu, BatchNorm, InstanceNorm2D
+from PuzzleLib.Modules import Module, Activation, SwapAxes, Mul, ModuleError, BatchNorm
 from PuzzleLib.Backend.Kernels import MatVec
 from PuzzleLib.Variable import Variable
 from PuzzleLib.Containers import Container, Sequential
 
 
+def splitAttentionMask(data):
+    return tuple(data) if isinstance(data, (tuple, list)) else (data, None)
+
+
+def joinAttentionMask(hiddenStates, attentionMask):
+    return hiddenStates if attentionMask is None else (hiddenStates, attentionMask)
+
+
 class BertConfig(object):
     def __init__(self,
                  vocab_size_or_json,
@@ -20,7 +28,8 @@ class BertConfig(object):
                  intermediate_size=3072,
                  max_position_embeddings=512,
                  type_vocab_size=2,
-                 segment_size=32):
+                 segment_size=32,
+                 output_size=4):
 
         if isinstance(vocab_size_or_json, str):
             with open(vocab_size_or_json, "r") as reader:
@@ -65,23 +74,51 @@ class BertLayerNorm(Module):
         self.bias = None
         self.setVar("bias", Variable(gpuarray.to_gpu(np.zeros(config.hidden_size, dtype=np.float32))))
         self.mul = Mul()
+
+        # Normalization modules depend on the sequence length and tiled scales on the number of rows,
+        # both are kept between calls and rebuilt only for new shapes or weights
+        self.norms = {}
+        self.getNorm(config.segment_size)
+
+        self.scaleCacheSize = 8
+        self.scaleCache = OrderedDict()
+
+    def getNorm(self, maps):
+        norm = self.norms.get(maps)
+
+        if norm is None:
+            norm = self.norms[maps] = InstanceNorm2D(maps, epsilon=self.epsilon)
+            norm.calcMode(self.calctype)
+
+        return norm
+
+    def getTiledScale(self, rows):
+        scale = self.scaleCache.get(rows)
+
+        if scale is None:
+            scale = self.scaleCache[rows] = gpuarray.tile(self.scale.reshape((1, ) + self.scale.shape), rows, axis=0)
+
+            if len(self.scaleCache) > self.scaleCacheSize:
+                self.scaleCache.popitem(last=False)
+        else:
+            self.scaleCache.move_to_end(rows)
+
+        return scale
         
     def updateData(self, data):
         batchsize, maps, h = data.shape
         
         data = data.reshape((batchsize, maps, h, 1))
-        norm = InstanceNorm2D(maps, epsilon=self.epsilon)
-        norm.calcMode(self.calctype)
-        data = norm(data)
+        data = self.getNorm(maps)(data)
         data = data.reshape((batchsize * maps, h))
 
-        tile = Tile(axis=0, times=data.shape[0])
-        tile.calcMode(self.calctype)
-        scale = tile(self.scale.reshape(tuple([1]) + self.scale.shape))
-        
-        data = self.mul([data, scale])
-        data = MatVec.addVecToMat(self.bias, data, axis=1, out=data)
+        data = self.mul([data, self.getTiledScale(data.shape[0])])
+        MatVec.addVecToMat(self.bias, data, axis=1, out=data)
         self.data = data.reshape(batchsize, maps, h)
+
+    def load(self, hdf, initvars=None, name=None, assumeUniqueNames=False, isRoot=True):
+        self.scaleCache.clear()
+        super().load(hdf, initvars, name, assumeUniqueNames, isRoot)
         
     def checkDataType(self, dtype):
         if dtype != self.calctype:
@@ -92,6 +129,9 @@ class BertLayerNorm(Module):
             return
 
         self.mul.calcMode(T)
+        for norm in self.norms.values():
+            norm.calcMode(T)
+        self.scaleCache.clear()
 
         variables = self.vars
         self.vars = {}
@@ -120,15 +160,31 @@ class BertEmbeddings(Container):
 
         self.append(BertLayerNorm(config, name='LayerNorm'))
 
+        self.idsCacheSize = 8
+        self.idsCache = OrderedDict()
+
+    def getConstantIds(self, shape):
+        ids = self.idsCache.get(shape)
+
+        if ids is None:
+            positionIds = gpuarray.to_gpu(np.tile(np.arange(shape[1], dtype=np.int32), (shape[0], 1)))
+            tokenTypeIds = gpuarray.zeros(shape, dtype=np.int32)
+            ids = self.idsCache[shape] = (positionIds, tokenTypeIds)
+
+            if len(self.idsCache) > self.idsCacheSize:
+                self.idsCache.popitem(last=False)
+        else:
+            self.idsCache.move_to_end(shape)
+
+        return ids
+
     def updateData(self, data):
         if self.acquireDtypesFrom(data) == np.int32:
             inputIds = data
-            tokenTypeIds = gpuarray.zeros(inputIds.shape, dtype=np.int32)
+            positionIds, tokenTypeIds = self.getConstantIds(inputIds.shape)
         else:
             inputIds, tokenTypeIds = data
-
-        seqlength = inputIds.shape[1]
-        positionIds = gpuarray.to_gpu(np.array([range(seqlength)]*inputIds.shape[0]).astype(np.int32))
+            positionIds, _ = self.getConstantIds(inputIds.shape)
 
         wordsEmbeddings = self.modules['wordEmbedder'](inputIds)
         positionEmbeddings = self.modules['positionEmbedder'](positionIds)
@@ -160,17 +216,18 @@ class BertSelfAttention(Container):
         self.append(Linear(config.hidden_size, self.allHeadSize, name='query'))
         self.append(Linear(config.hidden_size, self.allHeadSize, name='key'))
         self.append(Linear(config.hidden_size, self.allHeadSize, name='value'))
-        self.append(Mul(name='mul'))
+
+        self.swap = SwapAxes(axis1=1, axis2=2)
+        self.scoresSwap = SwapAxes(axis1=1, axis2=3)
+        self.softmax = SoftMax()
         
     def transpose(self, x):
         x = x.reshape(x.shape[:-1] + (self.num_attention_heads, self.attentionHeadSize))
-        swap = SwapAxes(axis1=1, axis2=2)
-        swap.calcMode(self.calctype)
-        x = swap(x)
+        x = self.swap(x)
         return x
 
     def updateData(self, data):
-        hiddenStates, attentionMask = data
+        hiddenStates, attentionMask = splitAttentionMask(data)
         
         mixedQueryLayer = self.modules['query'](hiddenStates)
         mixedKeyLayer = self.modules['key'](hiddenStates)
@@ -182,29 +239,23 @@ class BertSelfAttention(Container):
         
         batchsize, maps, h, w = queryLayer.shape
         
-        swap = SwapAxes(axis1=2, axis2=1)
-        swap.calcMode(self.calctype)
-        
+        # Keys are transposed and scores scaled inside the batched gemm
         A = queryLayer.reshape((batchsize * maps, h, w))
-        B = swap(keyLayer.reshape((batchsize * maps, h, w)))
-        attentionScores = mulTensorBatch(A, B, formatA="gbp", formatB="gbp", formatOut="gbp")
+        B = keyLayer.reshape((batchsize * maps, h, w))
+        attentionScores = mulTensorBatch(A, B, formatA="gbp", formatB="gbp", formatOut="gbp", transpB=True,
+                                         alpha=1 / math.sqrt(self.attentionHeadSize))
         attentionScores = attentionScores.reshape((batchsize, maps, h, h))
         
-        a = gpuarray.empty(attentionScores.shape, self.calctype).fill(1/math.sqrt(self.attentionHeadSize))
-        attentionScores = self.modules['mul']([attentionScores, a])
-        attentionScores = attentionScores + attentionMask
+        if attentionMask is not None:
+            attentionScores = attentionScores + attentionMask
         
-        softmax = SoftMax()
-        softmax.calcMode(self.calctype)
-        swap2 = SwapAxes(axis1=1, axis2=3)
-        swap2.calcMode(self.calctype)
-        attentionProbs = swap2(softmax(swap2(attentionScores)))
+        attentionProbs = self.scoresSwap(self.softmax(self.scoresSwap(attentionScores)))
 
         contextLayer = mulTensorBatch(attentionProbs.reshape((batchsize * maps, h, h)), \
                                       valueLayer.reshape((batchsize * maps, h, w)), \
                                       formatA="gbp", formatB="gbp", formatOut="gbp")
 
-        contextLayer = swap(contextLayer.reshape((batchsize, maps, h, w))).reshape((batchsize, h, self.allHeadSize))
+        contextLayer = self.swap(contextLayer.reshape((batchsize, maps, h, w))).reshape((batchsize, h, self.allHeadSize))
         self.data = contextLayer
         
     def calcMode(self, T):
@@ -214,6 +265,9 @@ class BertSelfAttention(Container):
 
             except Exception as e:
                 self.handleError(mod, e)
+
+        for mod in (self.swap, self.scoresSwap, self.softmax):
+            mod.calcMode(T)
         self.calctype = T
 
         
@@ -241,8 +295,8 @@ class BertAttention(Container):
         self.append(BertSelfOutput(config, name='output'))
 
     def updateData(self, data):
-        inputTensor, attentionMask = data
-        selfOutput = self.modules['self']((inputTensor, attentionMask))
+        inputTensor, attentionMask = splitAttentionMask(data)
+        selfOutput = self.modules['self'](joinAttentionMask(inputTensor, attentionMask))
         attentionOutput = self.modules['output']((selfOutput, inputTensor))
         self.data = attentionOutput
 
@@ -286,8 +340,8 @@ class BertLayer(Container):
         self.append(BertOutput(config, name='output'))
 
     def updateData(self, data):
-        hiddenStates, attentionMask = data
-        attentionOutput = self.modules['attention']((hiddenStates, attentionMask))
+        hiddenStates, attentionMask = splitAttentionMask(data)
+        attentionOutput = self.modules['attention'](joinAttentionMask(hiddenStates, attentionMask))
         intermediateOutput = self.modules['intermediate'](attentionOutput)
         layerOutput = self.modules['output']((intermediateOutput, attentionOutput))
         self.data = layerOutput
@@ -301,9 +355,9 @@ class BertEncoder(Container):
             self.append(BertLayer(config, name=i))    
 
     def updateData(self, data):
-        hiddenStates, attentionMask = data
+        hiddenStates, attentionMask = splitAttentionMask(data)
         for i in self.modules:
-            hiddenStates = self.modules[i]((hiddenStates, attentionMask))
+            hiddenStates = self.modules[i](joinAttentionMask(hiddenStates, attentionMask))
                    
         self.data = hiddenStates
     
@@ -333,17 +387,10 @@ class BertModel(Container):
         
     def updateData(self, data):
         inputIds = data
-        
-        attentionMask = np.ones(inputIds.shape)
 
-        attentionMask = (1.0 - attentionMask) * -10000.0
-        extendedAttentionMask = np.repeat(np.expand_dims(attentionMask, axis=1), inputIds.shape[1], axis=1)
-        extendedAttentionMask = np.repeat(np.expand_dims(extendedAttentionMask, axis=1), self.num_attention_heads, axis=1)
-        calctype = self.modules['embeddings'].modules['LayerNorm'].calctype
-        extendedAttentionMask = gpuarray.to_gpu(extendedAttentionMask.astype(calctype))
-        
+        # Inputs are never padded, so the all-ones attention mask would only add zeros to the scores
         embeddingOutput = self.modules['embeddings'](inputIds)
-        sequenceOutput = self.modules['encoder']((embeddingOutput, extendedAttentionMask))
+        sequenceOutput = self.modules['encoder'](embeddingOutput)
 
         self.data = sequenceOutput
             
@@ -406,7 +453,11 @@ class BertPunc(Container):
     def updateData(self, data):
         data = self.modules['lm'](data)
         data = data.reshape((data.shape[0], int(np.prod(data.shape[1:]))))
-        data = self.modules['bn'](data).astype(np.float16)
+        data = self.modules['bn'](data)
+
+        # Batch norm keeps float32 when the rest of the network runs in float16
+        if data.dtype != self.modules['dense'].calctype:
+            data = data.astype(self.modules['dense'].calctype)
         self.data = self.modules['dense'](data)
         
     def checkDataType(self, dtype):
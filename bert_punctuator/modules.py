@@ -2,11 +2,85 @@ import h5py
 import numpy as np
 from PuzzleLib import Config
 from PuzzleLib.Backend import gpuarray, Blas
+from PuzzleLib.Backend.Dnn import softmaxNd, instanceNorm2d
 from PuzzleLib.Backend.Kernels.Embedder import embed, embedBackwardParams
+from PuzzleLib.Backend.Kernels.ElementWise import geluKer
 from PuzzleLib.Backend.Kernels import MatVec
 from PuzzleLib.Variable import Variable
 from PuzzleLib.Modules.Module import ModuleError, Module
 from PuzzleLib.Modules import Reshape
+from PuzzleLib.Modules import SoftMax as SoftMaxModule, Gelu as GeluModule, InstanceNorm2D as InstanceNorm2DModule
+
+
+# The CPU backend of PuzzleLib has no kernels for embeddings, batched gemm, softmax, gelu and instance norm,
+# there they are computed with numpy
+
+def fromHost(data):
+    return gpuarray.to_gpu(np.ascontiguousarray(data))
+
+
+def mulTensorBatch(A, B, formatA="bgp", formatB="bgp", out=None, formatOut="bgp", transpA=False, transpB=False,
+                   alpha=1.0, beta=0.0):
+    if Blas.mulTensorBatch is not None:
+        return Blas.mulTensorBatch(A, B, formatA=formatA, formatB=formatB, out=out, formatOut=formatOut,
+                                   transpA=transpA, transpB=transpB, alpha=alpha, beta=beta)
+
+    A, B = A.get(copy=False), B.get(copy=False)
+    A = A if formatA == "gbp" else A.swapaxes(0, 1)
+    B = B if formatB == "gbp" else B.swapaxes(0, 1)
+
+    C = np.matmul(A.swapaxes(1, 2) if transpA else A, B.swapaxes(1, 2) if transpB else B)
+    if alpha != 1.0:
+        C *= alpha
+
+    C = C if formatOut == "gbp" else C.swapaxes(0, 1)
+    if out is None:
+        return fromHost(C)
+
+    out.set(C + beta * out.get(copy=False) if beta != 0.0 else C)
+    return out
+
+
+def erf(x):
+    # Abramowitz and Stegun 7.1.26, the absolute error is below 1.5e-7
+    t = 1.0 / (1.0 + 0.3275911 * np.abs(x))
+    y = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    return np.sign(x) * (1.0 - y * np.exp(-x * x))
+
+
+class SoftMax(SoftMaxModule):
+    def updateData(self, data):
+        if softmaxNd is not None:
+            super().updateData(data)
+            return
+
+        x = data.get()
+        x -= x.max(axis=1, keepdims=True)
+        np.exp(x, out=x)
+        x /= x.sum(axis=1, keepdims=True)
+        self.data = fromHost(x)
+
+
+class Gelu(GeluModule):
+    def updateData(self, data):
+        if geluKer is not None:
+            super().updateData(data)
+            return
+
+        x = data.get(copy=False)
+        self.data = fromHost((0.5 * x * (1.0 + erf(x / np.sqrt(2.0)))).astype(x.dtype))
+
+
+class InstanceNorm2D(InstanceNorm2DModule):
+    def updateData(self, data):
+        if instanceNorm2d is not None:
+            super().updateData(data)
+            return
+
+        x = data.get(copy=False)
+        mean, var = x.mean(axis=(2, 3), keepdims=True), x.var(axis=(2, 3), keepdims=True)
+        x = (x - mean) / np.sqrt(var + self.epsilon) * self.scale.get(copy=False) + self.bias.get(copy=False)
+        self.data = fromHost(x.astype(data.dtype))
 
 
 class Embedder(Module):
@@ -95,7 +169,10 @@ class Embedder(Module):
     def updateData(self, data):
         if Config.verifyData:
             self.verifyData(data)
-        self.data = embed(data, self.W)
+        if embed is None:
+            self.data = fromHost(np.take(self.W.get(copy=False), data.get(copy=False), axis=0))
+        else:
+            self.data = embed(data, self.W)
 
     def updateGrad(self, grad):
         self.grad = None
@@ -26,7 +26,7 @@ def whitespace_tokenize(text):
 
 
 class BertTokenizer(object):
-    def __init__(self, vocab_file, lower_case=True):
+    def __init__(self, vocab_file, lower_case=True, cache_size=100000):
         if not os.path.isfile(vocab_file):
             raise ValueError(
                 "Can't find a vocabulary file at path {}".format(vocab_file))
@@ -36,6 +36,10 @@ class BertTokenizer(object):
         self.basic_tokenizer = BasicTokenizer(lower_case=lower_case)
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
 
+        # Transcripts come from a closed lexicon, so the ids of recent words are kept
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
     def tokenize(self, text):
         split_tokens = []
         for token in self.basic_tokenizer.tokenize(text):
@@ -43,6 +47,18 @@ class BertTokenizer(object):
                 split_tokens.append(sub_token)
         return split_tokens
 
+    def tokenize_to_ids(self, text):
+        ids = self.cache.get(text)
+
+        if ids is None:
+            ids = self.cache[text] = tuple(self.convert_tokens_to_ids(self.tokenize(text)))
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(text)
+
+        return list(ids)
+
     def convert_tokens_to_ids(self, tokens):
         ids = []
         for token in tokens:
@@ -123,28 +139,44 @@ class WordpieceTokenizer(object):
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
 
+        # Prefix tries for word-initial pieces and for "##" continuation pieces,
+        # the None key of a node holds the vocabulary token ending there
+        self.start_trie = {}
+        self.continuation_trie = {}
+
+        for token in vocab:
+            self.add_to_trie(self.start_trie, token, token)
+            if token.startswith("##"):
+                self.add_to_trie(self.continuation_trie, token[2:], token)
+
+    @staticmethod
+    def add_to_trie(trie, chars, token):
+        node = trie
+        for char in chars:
+            node = node.setdefault(char, {})
+        node[None] = token
+
     def tokenize(self, text):
         output_tokens = []
         for token in whitespace_tokenize(text):
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
+            if len(token) > self.max_input_chars_per_word:
                 output_tokens.append(self.unk_token)
                 continue
 
             is_bad = False
             start = 0
             sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
+            while start < len(token):
+                node = self.start_trie if start == 0 else self.continuation_trie
+                cur_substr, end = None, start
+
+                for i in range(start, len(token)):
+                    node = node.get(token[i])
+                    if node is None:
                         break
-                    end -= 1
+                    if None in node:
+                        cur_substr, end = node[None], i + 1
+
                 if cur_substr is None:
                     is_bad = True
                     break
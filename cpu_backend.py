@@ -0,0 +1,112 @@
+import os
+import json
+import logging
+import numpy as np
+
+
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def setup_cpu_backend(threads=0):
+    # Has to run before PuzzleLib.Backend is imported, models built afterwards get no gradient buffers
+    if threads > 0:
+        set_thread_budget(threads)
+
+    from PuzzleLib import Config
+    Config.backend = Config.Backend.cpu
+    Config.globalEvalMode = True
+
+
+def set_thread_budget(threads):
+    # Thread pools read the environment when their library is loaded, pools of already loaded BLAS libraries
+    # are limited with threadpoolctl when it is installed
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(threads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+
+
+def share_weights(net, model_path, folder):
+    # Parameters of a loaded network are written once to a flat file next to the index of their offsets,
+    # then replaced with read-only views of the memory-mapped file, so that all processes share its pages
+    from PuzzleLib.CPU.CPUArray import CPUArray
+
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    weights_path, index_path = os.path.join(folder, name + '.weights'), os.path.join(folder, name + '.json')
+
+    stat = os.stat(model_path)
+    key = '{}:{}:{}'.format(os.path.abspath(model_path), stat.st_size, stat.st_mtime_ns)
+
+    vartable = net.getVarTable()
+    index = load_index(index_path, key)
+
+    if index is None:
+        try:
+            index = save_weights(vartable, weights_path, index_path, key)
+        except OSError as e:
+            logging.exception(e)
+            return
+
+    weights = np.memmap(weights_path, dtype=np.uint8, mode='r')
+
+    for var, names in vartable.items():
+        offset, shape, dtype = index['vars'][names[0]]
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        data = weights[offset:offset + size].view(dtype).reshape(shape)
+
+        var.data = CPUArray(data.shape, data.dtype, data=data, acquire=True)
+        for var_name in names:
+            set_var(net, var_name, var)
+
+
+def set_var(net, name, var):
+    # Container.setVar can't reach modules named by integers, such as the layers of the BERT encoder
+    path, var_name = name.split('.')[:-1], name.split('.')[-1]
+    module = net
+
+    for key in path:
+        module = module.modules[key] if key in module.modules else module.modules[int(key)]
+
+    module.setVar(var_name, var)
+
+
+def load_index(index_path, key):
+    try:
+        with open(index_path, encoding='UTF-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    return index if index.get('key') == key else None
+
+
+def save_weights(vartable, weights_path, index_path, key):
+    os.makedirs(os.path.dirname(weights_path) or '.', exist_ok=True)
+    index, offset = {'key': key, 'vars': {}}, 0
+    tmp_path = '{}.{}.tmp'.format(weights_path, os.getpid())
+
+    with open(tmp_path, 'wb') as f:
+        for var, names in vartable.items():
+            data = np.ascontiguousarray(var.data.get())
+
+            # Every array starts at a 64 byte boundary
+            padding = -offset % 64
+            f.write(b'\0' * padding)
+            offset += padding
+
+            f.write(data.tobytes())
+            index['vars'][names[0]] = [offset, list(data.shape), data.dtype.str]
+            offset += data.nbytes
+
+    os.replace(tmp_path, weights_path)
+
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    with open(tmp_path, 'w', encoding='UTF-8') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+    return index
@@ -1,15 +1,30 @@
 import numpy as np
 import scipy
-from utils import stft, magphase
+from utils import stft_magnitude, get_window, pad_center, frame
 from pydub import AudioSegment
 
 
+def pcen_coefficient(sr=16000, hop_length=512, t=0.395):
+    return 1 - np.exp(-float(hop_length) / (t * sr))
+
+
+def pcen_compress(e, m, eps=0.000001, alpha=0.98, delta=2.0, r=0.5):
+    # m is the smoothed energy, it is overwritten with the result
+    m += eps
+    np.power(m, -alpha, out=m)
+    m *= e
+    m += delta
+    np.power(m, r, out=m)
+    m -= delta ** r
+
+    return m
+
+
 def pcen2(e, sr=16000, hop_length=512, t=0.395, eps=0.000001, alpha=0.98, delta=2.0, r=0.5):
-    s = 1 - np.exp(-float(hop_length) / (t * sr))
-    m = scipy.signal.lfilter([s], [1, s - 1], e)
-    smooth = (eps + m) ** (-alpha)
+    s = e.dtype.type(pcen_coefficient(sr, hop_length, t))
+    m = scipy.signal.lfilter(np.array([s]), np.array([1, s - 1], dtype=e.dtype), e)
 
-    return (e * smooth + delta) ** r - delta ** r
+    return pcen_compress(e, m, eps, alpha, delta, r)
 
 
 def load_audio(path, sample_rate):
@@ -18,27 +33,106 @@ def load_audio(path, sample_rate):
     sound = sound.set_channels(1)
     sound = sound.set_sample_width(2)
 
-    return np.array(sound.get_array_of_samples()).astype(float)
+    return np.array(sound.get_array_of_samples()).astype(np.float32)
 
 
-def preprocess(audio_path, sample_rate=16000, window_size=0.02, window_stride=0.01, window='hamming'):
-    audio = load_audio(audio_path, sample_rate)
+def preprocess(audio, sample_rate=16000, window_size=0.02, window_stride=0.01, window='hamming'):
+    if isinstance(audio, str):
+        audio = load_audio(audio, sample_rate)
+    else:
+        audio = np.asarray(audio, dtype=np.float32)
+
     nfft = int(sample_rate * window_size)
     win_length = nfft
     hop_length = int(sample_rate * window_stride)
 
-    d = stft(audio, n_fft=nfft, hop_length=hop_length,
-             win_length=win_length, window=window)
+    spect = stft_magnitude(audio, n_fft=nfft, hop_length=hop_length,
+                           win_length=win_length, window=window)
 
-    spect, phase = magphase(d)
     pcen_result = pcen2(e=spect, sr=sample_rate, hop_length=hop_length)
-    mean_pcen = pcen_result.mean()
-    std_pcen = pcen_result.std()
+    del spect
+
+    return normalize(pcen_result)
+
+
+def normalize(features):
+    # Normalization is done in place, np.std would allocate a float64 copy of the features
+    features -= features.mean(dtype=np.float64)
+    std = np.sqrt(np.einsum('ij,ij->', features, features, dtype=np.float64) / features.size)
+    if std > 0:
+        features /= std
+
+    return features
+
+
+def split_audio(audio, sample_rate=16000, segment_length=30.0, search_length=5.0, frame_length=0.02):
+    # Long audio is cut into segments of at most segment_length seconds, every cut is made at the quietest frame
+    # of the last search_length seconds of a segment so that words are rarely split between segments
+    frame_size = int(sample_rate * frame_length)
+    frames_count = len(audio) // frame_size
+    segment_frames = max(2, int(segment_length / frame_length))
+    search_frames = min(segment_frames - 1, max(1, int(search_length / frame_length)))
+
+    frames = audio[:frames_count * frame_size].reshape((frames_count, frame_size))
+    energy = np.einsum('ij,ij->i', frames, frames, dtype=np.float64)
+
+    # The last segment is kept at least search_length long by cutting only when enough audio is left after the cut
+    cuts, start = [0], 0
+    while frames_count - start > segment_frames + search_frames:
+        search_start = start + segment_frames - search_frames
+        start = search_start + int(np.argmin(energy[search_start:start + segment_frames]))
+        cuts.append(start)
+
+    bounds = [cut * frame_size for cut in cuts] + [len(audio)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class StreamingPreprocessor(object):
+    def __init__(self, sample_rate=16000, window_size=0.02, window_stride=0.01, window='hamming'):
+        self.nfft = int(sample_rate * window_size)
+        self.hop_length = int(sample_rate * window_stride)
+        self.freq_size = 1 + self.nfft // 2
 
-    pcen_result = np.add(pcen_result, -mean_pcen)
-    pcen_result = pcen_result / std_pcen
+        fft_window = pad_center(get_window(window, self.nfft, fftbins=True), self.nfft)
+        self.fft_window = fft_window.reshape((-1, 1))
+        self.pcen_coefficient = pcen_coefficient(sample_rate, self.hop_length)
 
-    return pcen_result
+        # lfilter state of PCEN smoothing
+        self.zi = np.zeros((self.freq_size, 1))
+
+        self.samples = np.zeros(0)
+        self.started = False
+
+    def push(self, audio, final=False):
+        pad = self.nfft // 2
+        self.samples = np.concatenate([self.samples, np.asarray(audio, dtype=float)])
+
+        if not self.started:
+            if len(self.samples) <= pad:
+                return np.zeros((self.freq_size, 0))
+
+            self.samples = np.pad(self.samples, (pad, 0), mode='reflect')
+            self.started = True
+
+        if final:
+            self.samples = np.pad(self.samples, (0, pad), mode='reflect')
+            n_frames = 1 + (len(self.samples) - self.nfft) // self.hop_length
+        else:
+            # Hold back the last frame so that the reflect padding at the end of the stream has enough samples
+            n_frames = (len(self.samples) - self.nfft) // self.hop_length
+
+        if n_frames <= 0:
+            return np.zeros((self.freq_size, 0))
+
+        y_frames = frame(self.samples[:(n_frames - 1) * self.hop_length + self.nfft],
+                         frame_length=self.nfft, hop_length=self.hop_length)
+        spect = np.abs(np.fft.rfft(self.fft_window * y_frames, axis=0))
+        self.samples = self.samples[n_frames * self.hop_length:]
+
+        m, self.zi = scipy.signal.lfilter([self.pcen_coefficient], [1, self.pcen_coefficient - 1], spect, zi=self.zi)
+        # Features are returned before normalization, every recognized window is normalized with its own
+        # statistics like the whole audio in preprocess
+        return pcen_compress(spect, m)
 
 
 def get_batch(batch):
@@ -71,6 +165,29 @@ def get_batch(batch):
     return inputs, input_percentages, targets, target_sizes, input_file_path_and_transcription
 
 
+def get_inference_batch(spectrograms, dtype=np.float32, out=None):
+    # out is an optional byte buffer the batch is written to, only the padding is zeroed then
+    freq_size = spectrograms[0].shape[0]
+    mini_batch_size = len(spectrograms)
+    max_seq_length = max(spectrogram.shape[1] for spectrogram in spectrograms)
+    shape = (mini_batch_size, freq_size, max_seq_length)
+
+    if out is None:
+        inputs = np.zeros(shape, dtype=dtype)
+    else:
+        inputs = out[:int(np.prod(shape)) * np.dtype(dtype).itemsize].view(dtype).reshape(shape)
+    seq_lengths = np.zeros(shape=(mini_batch_size,), dtype=int)
+
+    for x, spectrogram in enumerate(spectrograms):
+        seq_length = spectrogram.shape[1]
+        inputs[x, :, :seq_length] = spectrogram
+        if out is not None:
+            inputs[x, :, seq_length:] = 0
+        seq_lengths[x] = seq_length
+
+    return inputs, seq_lengths
+
+
 class DataLoader(object):
     def __init__(self, dataset, batch_sampler):
         self.dataset = dataset
@@ -98,7 +215,7 @@ class DataLoader(object):
 
 
 class SpectrogramDataset(object):
-    def __init__(self, labels, sample_rate, window_size, window_stride, manifest_file_path):
+    def __init__(self, labels, sample_rate, window_size, window_stride, manifest_file_path, feature_store=None):
         self.manifest_file_path = manifest_file_path
         with open(self.manifest_file_path) as f:
             lines = f.readlines()
@@ -108,11 +225,17 @@ class SpectrogramDataset(object):
         self.sample_rate = sample_rate
         self.window_size = window_size
         self.window_stride = window_stride
+        self.feature_store = feature_store
 
     def __getitem__(self, index):
         sample = self.ids[index]
         audio_path, transcript_loaded = sample[0], sample[1]
-        spectrogram = preprocess(audio_path, self.sample_rate, self.window_size, self.window_stride)
+
+        # Precomputed spectrograms are read-only views of the memory-mapped store
+        if self.feature_store is not None:
+            spectrogram = self.feature_store[index]
+        else:
+            spectrogram = preprocess(audio_path, self.sample_rate, self.window_size, self.window_stride)
         transcript = list(filter(None, [self.labels_map.get(x) for x in list(transcript_loaded)]))
         return spectrogram, transcript, audio_path, transcript_loaded
 
@@ -1,73 +1,353 @@
+import os
+import ctypes
+import hashlib
+import functools
+import logging
+import itertools
+import threading
+import queue
+import signal
+import multiprocessing
+from multiprocessing import connection, reduction
+from concurrent.futures import Future
 import numpy as np
 import math
-import itertools
-from scipy.special import softmax
+import metrics
 np.seterr(divide='ignore')
 
 
+decoder_restarts = metrics.counter('asr_decoder_restarts_total', 'Decoder processes started again after they exited')
+
+
 class DecodeResult:
     def __init__(self, score, words):
         self.score, self.words = score, words
         self.text = " ".join(word["word"] for word in words)
 
 
-class GreedyDecoder:
-    def __init__(self, labels, blank_idx=0):
-        self.labels, self.blank_idx = labels, blank_idx
-        self.delim_idx = self.labels.index("|")
+def merge_results(results):
+    # Joins results of consecutive audio segments, the score is the mean of segment scores weighted by word count
+    if len(results) == 1:
+        return results[0]
 
+    words = [word for result in results for word in result.words]
+    words_count = sum(len(result.words) for result in results)
+    score = sum(float(result.score) * len(result.words) for result in results) / max(1, words_count)
 
-    def decode(self, output, start_timestamp=0, frame_time=0.02):
-        best_path = np.argmax(output.astype(np.float32, copy=False), axis=1)
-        score = None
+    return DecodeResult(round(score, 2), words)
 
-        words, new_word, i = [], True, 0
-        current_word, current_timestamp, end_idx = None, start_timestamp, 0
-        words_len = 0
-
-        for k, g in itertools.groupby(best_path):
-            if k != self.blank_idx:
-                if new_word and k != self.delim_idx:
-                    new_word, start_idx = False, i
-                    current_word, current_timestamp = self.labels[k], frame_time * i + start_timestamp
-
-                elif k == self.delim_idx:
-                    end_timestamp = frame_time * i + start_timestamp
-                    new_word, end_idx = True, i
-                    word_score = output[range(start_idx, end_idx), best_path[range(start_idx, end_idx)]] - np.max(output)
-                    if score is not None:
-                        score = np.hstack([score, word_score])
-                    else:
-                        score = word_score
-                    word_confidence = np.round(np.exp(word_score.mean() / max(1, end_idx - start_idx)) * 100.0, 2)
-                    words_len += end_idx - start_idx
-                    words.append({
-                        "word": current_word,
-                        "start": np.round(current_timestamp, 2),
-                        "end": np.round(end_timestamp, 2),
-                        "confidence": word_confidence
-                    })
 
+class GreedyDecoder:
+    def __init__(self, labels, blank_idx=0):
+        self.labels, self.blank_idx = labels, blank_idx
+        self.delim_idx = self.labels.index("|") if "|" in self.labels else self.labels.index(" ")
+        self.label_array = np.array(list(self.labels))
+
+    def decode(self, output, start_timestamp=0, frame_time=0.02, max_len=None):
+        output = output.astype(np.float32, copy=False)
+        best_path = np.argmax(output, axis=-1)
+        row_max = np.take_along_axis(output, best_path[..., None], axis=-1)[..., 0]
+
+        if output.ndim == 3:
+            max_len = np.broadcast_to(output.shape[1] if max_len is None else max_len, (output.shape[0],))
+            return [
+                self.decode_path(best_path[i, :max_len[i]], row_max[i, :max_len[i]], start_timestamp, frame_time)
+                for i in range(output.shape[0])
+            ]
+
+        return self.decode_path(best_path[:max_len], row_max[:max_len], start_timestamp, frame_time)
+
+    def decode_path(self, best_path, row_max, start_timestamp, frame_time):
+        if len(best_path) == 0:
+            return DecodeResult(0.0, [])
+
+        run_starts = np.concatenate([[0], np.flatnonzero(best_path[1:] != best_path[:-1]) + 1])
+        run_labels = best_path[run_starts]
+
+        voiced = run_labels != self.blank_idx
+        run_starts, run_labels = run_starts[voiced], run_labels[voiced]
+
+        # A word starts at the first letter after a delimiter and ends at the next delimiter,
+        # delimiters that do not close a word are skipped
+        is_delim = run_labels == self.delim_idx
+        after_delim = np.concatenate([[True], is_delim[:-1]])
+        word_starts = np.flatnonzero(~is_delim & after_delim)
+        word_ends = np.flatnonzero(is_delim & ~after_delim)
+        words_count = len(word_ends)
+
+        if words_count == 0:
+            return DecodeResult(0.0, [])
+
+        word_ids = np.cumsum(~is_delim & after_delim) - 1
+        letters = ~is_delim & (word_ids < words_count)
+        chars = "".join(self.label_array[run_labels[letters]])
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(word_ids[letters], minlength=words_count))])
+
+        start_idx, end_idx = run_starts[word_starts[:words_count]], run_starts[word_ends]
+        frames_count = end_idx - start_idx
+
+        frame_scores = np.concatenate([[0.0], np.cumsum(row_max - row_max.max(), dtype=np.float64)])
+        word_scores = frame_scores[end_idx] - frame_scores[start_idx]
+
+        confidences = np.round(np.exp(word_scores / frames_count / np.maximum(1, frames_count)) * 100.0, 2)
+        starts = np.round(frame_time * start_idx + start_timestamp, 2)
+        ends = np.round(frame_time * end_idx + start_timestamp, 2)
+
+        words = [
+            {
+                "word": chars[bounds[i]:bounds[i + 1]],
+                "start": start,
+                "end": end,
+                "confidence": confidence
+            } for i, (start, end, confidence) in enumerate(zip(starts.tolist(), ends.tolist(), confidences.tolist()))
+        ]
+
+        words_len = frames_count.sum()
+        score = np.round(np.exp(word_scores.sum() / words_len / max(1, words_len)) * 100.0, 2)
+
+        return DecodeResult(float(score), words)
+
+
+class DecoderWorker:
+    def __init__(self, conn):
+        self.conn = conn
+        self.jobs = {}
+        self.send_lock = threading.Lock()
+
+
+class DecoderPool:
+    # Decoder processes work with their own copies of the decoder, posteriors are copied into shared memory slots
+    # so that only slot numbers and results go through the pipes. Processes are forked by a spawner process that is
+    # forked when the pool is created, so that processes restarted after a crash do not inherit locks held by
+    # threads of the server. The spawner builds the decoder with load_decoder when the pool is started
+    def __init__(self, load_decoder, processes, labels_count, slot_frames):
+        context = multiprocessing.get_context('fork')
+        slots = 2 * processes
+
+        self.memory = context.RawArray(ctypes.c_float, slots * slot_frames * labels_count)
+        self.buffers = np.frombuffer(self.memory, dtype=np.float32).reshape((slots, slot_frames, labels_count))
+
+        self.spawner_conn, spawner_conn = context.Pipe()
+        self.spawner = context.Process(target=run_spawner,
+                                       args=(load_decoder, spawner_conn, self.spawner_conn, self.buffers), daemon=True)
+        self.spawner.start()
+        spawner_conn.close()
+
+        self.free_slots = queue.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+
+        self.processes, self.workers, self.collector = processes, [], None
+        self.blank_idx, self.delim_idx, self.error = None, None, None
+        self.job_ids, self.lock, self.spawn_lock = itertools.count(), threading.Lock(), threading.Lock()
+        self.start_lock = threading.Lock()
+        self.closed = False
+
+    def start(self):
+        # Starts the decoder processes and waits until the spawner has built the decoder, returns the pool
+        with self.start_lock:
+            if self.error is not None:
+                raise Exception(self.error)
+            if self.collector is not None:
+                return self
+
+            workers = [self.start_worker() for _ in range(self.processes)]
+            try:
+                self.error, indices = self.spawner_conn.recv()
+            except (EOFError, OSError) as e:
+                self.error, indices = 'Decoder spawner exited: {}'.format(e), None
+
+            if self.error is not None:
+                for worker in workers:
+                    worker.conn.close()
+                raise Exception(self.error)
+
+            self.blank_idx, self.delim_idx = indices
+            self.workers = workers
+            self.collector = threading.Thread(target=self.collect, name='decoder-pool', daemon=True)
+            self.collector.start()
+
+        return self
+
+    def start_worker(self):
+        conn, worker_conn = multiprocessing.Pipe()
+        with self.spawn_lock:
+            reduction.send_handle(self.spawner_conn, worker_conn.fileno(), self.spawner.pid)
+        worker_conn.close()
+        return DecoderWorker(conn)
+
+    def submit(self, output, start_timestamp=0, frame_time=0.02):
+        future = Future()
+        t, n = output.shape
+        slot = None
+
+        if t <= self.buffers.shape[1] and n == self.buffers.shape[2]:
+            slot = self.free_slots.get()
+            self.buffers[slot, :t] = output
+            task = (None, slot, t, None, start_timestamp, frame_time)
+        else:
+            # Posteriors that do not fit into a slot are sent through the pipe
+            task = (None, None, t, output, start_timestamp, frame_time)
+
+        with self.lock:
+            if len(self.workers) == 0:
+                if slot is not None:
+                    self.free_slots.put(slot)
+                raise Exception('No decoder processes are running')
+
+            worker = min(self.workers, key=lambda worker: len(worker.jobs))
+            job = next(self.job_ids)
+            worker.jobs[job] = (future, slot)
+
+        # Jobs sent to a process that has died are failed by the collector
+        try:
+            with worker.send_lock:
+                worker.conn.send((job, ) + task[1:])
+        except OSError:
+            pass
+
+        return future
+
+    def collect(self):
+        while True:
+            with self.lock:
+                workers = list(self.workers)
+
+            for conn in connection.wait([worker.conn for worker in workers]):
+                worker = next(worker for worker in workers if worker.conn is conn)
+                try:
+                    job, result, error = conn.recv()
+                except (EOFError, OSError):
+                    # The process has died, its results are all received before the end of the pipe
+                    self.restart(worker)
+                    continue
+
+                with self.lock:
+                    future, slot = worker.jobs.pop(job)
+                if slot is not None:
+                    self.free_slots.put(slot)
+
+                if error is not None:
+                    future.set_exception(Exception(error))
                 else:
-                    current_word += self.labels[k]
-
-            i += sum(1 for _ in g)
-
-        score = np.round(np.exp(score.mean() / max(1, words_len)) * 100.0, 2)
-
-        return DecodeResult(score, words)
+                    future.set_result(result)
+
+            if self.closed:
+                return
+
+    def restart(self, worker):
+        with self.lock:
+            self.workers.remove(worker)
+            jobs, worker.jobs = worker.jobs, {}
+        worker.conn.close()
+
+        for future, slot in jobs.values():
+            if slot is not None:
+                self.free_slots.put(slot)
+            future.set_exception(Exception('Decoder process exited'))
+
+        if self.closed:
+            return
+
+        logging.error('Decoder process exited with %d jobs, starting a new one', len(jobs))
+        decoder_restarts.inc()
+        try:
+            worker = self.start_worker()
+        except (EOFError, OSError) as e:
+            logging.exception(e)
+            return
+
+        with self.lock:
+            self.workers.append(worker)
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            workers = list(self.workers)
+        for worker in workers:
+            with worker.send_lock:
+                worker.conn.send(None)
+        self.spawner_conn.close()
+        if self.collector is not None:
+            self.collector.join()
+        self.spawner.join()
+
+
+def run_spawner(load_decoder, conn, pool_conn, buffers):
+    # Builds the decoder when the first decoder process is requested and reports whether it succeeded,
+    # then receives the ends of pipes of new decoder processes, exited processes are reaped by the kernel
+    pool_conn.close()
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    decoder = None
+
+    while True:
+        try:
+            fd = reduction.recv_handle(conn)
+        except (EOFError, OSError):
+            return
+
+        if decoder is None:
+            try:
+                decoder = load_decoder()
+            except Exception as e:
+                logging.exception(e)
+                conn.send(('{}: {}'.format(type(e).__name__, e), None))
+                return
+            conn.send((None, (decoder.blank_idx, decoder.delim_idx)))
+
+        if os.fork() == 0:
+            conn.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            try:
+                run_decoder(decoder, connection.Connection(fd), buffers)
+            finally:
+                os._exit(0)
+
+        os.close(fd)
+
+
+def run_decoder(decoder, conn, buffers):
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+
+        job, slot, t, output, start_timestamp, frame_time = task
+        try:
+            output = buffers[slot, :t] if output is None else output
+            conn.send((job, decoder.decode(output, start_timestamp=start_timestamp, frame_time=frame_time), None))
+        except Exception as e:
+            conn.send((job, None, '{}: {}'.format(type(e).__name__, e)))
 
 
 class TrieDecoder:
-    def __init__(self, lexicon, tokens, lm_path, beam_threshold=30):
+    def __init__(self, lexicon, tokens, lm_path, beam_threshold=30, cache_path=None):
         from trie_decoder.common import Dictionary, create_word_dict, load_words
         from trie_decoder.decoder import CriterionType, DecoderOptions, KenLM, LexiconDecoder
-        lexicon = load_words(lexicon)
-        self.wordDict = create_word_dict(lexicon)
         self.tokenDict = Dictionary(tokens)
-        self.lm = KenLM(lm_path, self.wordDict)
 
-        trie, self.sil_idx, self.blank_idx, self.unk_idx = self.get_trie(lexicon)
+        cache_key = get_cache_key(lexicon, tokens, lm_path)
+        cache = load_trie_cache(cache_path, cache_key) if cache_path else None
+
+        if cache is None:
+            lexicon = load_words(lexicon)
+            self.wordDict = create_word_dict(lexicon)
+            self.lm = KenLM(lm_path, self.wordDict)
+            cache = self.get_lexicon_arrays(lexicon)
+
+            if cache_path:
+                try:
+                    save_trie_cache(cache_path, cache_key, cache)
+                except OSError as e:
+                    logging.exception(e)
+        else:
+            self.wordDict = create_word_dict({word: [] for word in cache["words"].tolist()})
+            self.lm = KenLM(lm_path, self.wordDict)
+
+        trie, self.sil_idx, self.blank_idx, self.unk_idx = self.get_trie(cache)
         transitions = np.zeros((self.tokenDict.index_size(), self.tokenDict.index_size())).flatten()
 
         opts = DecoderOptions(
@@ -79,30 +359,74 @@ class TrieDecoder:
         )
         self.delim_idx = self.tokenDict.get_index("|")
 
-    def get_trie(self, lexicon):
+        # Reusable buffers for the log-probabilities passed to the native decoder and for their exponents
+        self.log_probs = np.empty((0, self.tokenDict.index_size()), dtype=np.float32)
+        self.exps = np.empty_like(self.log_probs)
+
+    def get_lexicon_arrays(self, lexicon):
         from trie_decoder.common import tkn_to_idx
+        start_state = self.lm.start(False)
+        words, scores, spelling_words, spelling_lengths, spelling_tokens = [], [], [], [], []
+
+        for word, spellings in lexicon.items():
+            _, score = self.lm.score(start_state, self.wordDict.get_index(word))
+            words.append(word)
+            scores.append(np.round(score, 2))
+
+            for spelling in spellings:
+                spelling_indices = tkn_to_idx(spelling, self.tokenDict, 0)
+                spelling_words.append(len(words) - 1)
+                spelling_lengths.append(len(spelling_indices))
+                spelling_tokens.extend(spelling_indices)
+
+        return {
+            "words": np.array(words),
+            "scores": np.array(scores, dtype=np.float64),
+            "spelling_words": np.array(spelling_words, dtype=np.int32),
+            "spelling_offsets": np.concatenate([[0], np.cumsum(spelling_lengths, dtype=np.int64)]),
+            "spelling_tokens": np.array(spelling_tokens, dtype=np.int32)
+        }
+
+    def get_trie(self, cache):
         from trie_decoder.decoder import SmearingMode, Trie
         unk_idx = self.wordDict.get_index("<unk>")
         sil_idx = blank_idx = self.tokenDict.get_index("#")
 
         trie = Trie(self.tokenDict.index_size(), sil_idx)
-        start_state = self.lm.start(False)
 
-        for word, spellings in lexicon.items():
-            usr_idx = self.wordDict.get_index(word)
-            _, score = self.lm.score(start_state, usr_idx)
-            score = np.round(score, 2)
+        usr_indices = [self.wordDict.get_index(word) for word in cache["words"].tolist()]
+        scores = cache["scores"].tolist()
+        offsets = cache["spelling_offsets"].tolist()
+        spelling_tokens = cache["spelling_tokens"].tolist()
 
-            for spelling in spellings:
-                spelling_indices = tkn_to_idx(spelling, self.tokenDict, 0)
-                trie.insert(spelling_indices, usr_idx, score)
+        for i, word in enumerate(cache["spelling_words"].tolist()):
+            trie.insert(spelling_tokens[offsets[i]:offsets[i + 1]], usr_indices[word], scores[word])
 
         trie.smear(SmearingMode.MAX)
 
         return trie, sil_idx, blank_idx, unk_idx
 
-    def decode(self, output, start_timestamp=0, frame_time=0.02):
-        output = np.log(softmax(output[:, :].astype(np.float32, copy=False), axis=-1))
+    def log_softmax(self, output):
+        t, n = output.shape
+        if self.log_probs.shape[0] < t or self.log_probs.shape[1] != n:
+            self.log_probs = np.empty((t, n), dtype=np.float32)
+            self.exps = np.empty_like(self.log_probs)
+
+        # Computed in place in the contiguous float32 buffer, only the per-frame maxima and sums are allocated
+        log_probs, exps = self.log_probs[:t], self.exps[:t]
+        log_probs[...] = output
+        log_probs -= log_probs.max(axis=-1, keepdims=True)
+        np.exp(log_probs, out=exps)
+        log_probs -= np.log(exps.sum(axis=-1, keepdims=True))
+
+        return log_probs
+
+    def decode(self, output, start_timestamp=0, frame_time=0.02, max_len=None):
+        if output.ndim == 3:
+            max_len = np.broadcast_to(output.shape[1] if max_len is None else max_len, (output.shape[0],))
+            return [self.decode(output[i, :max_len[i]], start_timestamp, frame_time) for i in range(output.shape[0])]
+
+        output = self.log_softmax(output[:max_len])
 
         t, n = output.shape
         result = self.trieDecoder.decode(output.ctypes.data, t, n)[0]
@@ -145,3 +469,67 @@ class TrieDecoder:
         score = np.round(np.exp(result.score / max(1, words_len)), 2)
 
         return DecodeResult(score, words)
+
+
+def load_decoder(config):
+    if not int(config['Wav2Letter']['greedy']):
+        lexicon = config['Wav2Letter']['lexicon']
+        tokens = config['Wav2Letter']['tokens']
+        lm_path = config['Wav2Letter']['lm_path']
+        beam_threshold = float(config['Wav2Letter']['beam_threshold'])
+        trie_cache = config['Wav2Letter'].get('trie_cache', '')
+        return TrieDecoder(lexicon, tokens, lm_path, beam_threshold, trie_cache)
+
+    return GreedyDecoder(config['Wav2Letter']['labels'][1:-1])
+
+
+def start_decode_pool(config):
+    # Only forks the spawner of the decoder processes, the decoder is built by the pool start,
+    # returns None when decoding runs in the server process
+    processes = int(config['Wav2Letter'].get('decode_processes', 0))
+    if processes <= 0:
+        return None
+
+    segment_length = float(config['Wav2Letter'].get('segment_length', 0))
+    segment_search = float(config['Wav2Letter'].get('segment_search', 5.0))
+    window_stride = float(config['Wav2Letter']['window_stride'])
+
+    slot_length = segment_length + segment_search if segment_length > 0 else 60.0
+    return DecoderPool(functools.partial(load_decoder, config), processes, len(config['Wav2Letter']['labels'][1:-1]),
+                       int(slot_length / (2 * window_stride)) + 1)
+
+
+def get_cache_key(lexicon, tokens, lm_path):
+    # Lexicon and tokens are hashed by contents, the language model is only identified
+    # by its size and modification time since hashing a multi-gigabyte file would cost more than the cache saves
+    key = hashlib.sha1()
+
+    for path in (lexicon, tokens):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                key.update(block)
+
+    stat = os.stat(lm_path)
+    key.update('{}:{}:{}'.format(os.path.abspath(lm_path), stat.st_size, stat.st_mtime_ns).encode())
+
+    return key.hexdigest()
+
+
+def load_trie_cache(cache_path, cache_key):
+    if not os.path.exists(cache_path):
+        return None
+
+    try:
+        with np.load(cache_path) as cache:
+            if str(cache["key"]) != cache_key:
+                return None
+            return {name: cache[name] for name in cache.files if name != "key"}
+    except Exception:
+        return None
+
+
+def save_trie_cache(cache_path, cache_key, arrays):
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, key=np.array(cache_key), **arrays)
+    os.replace(tmp_path, cache_path)
@@ -0,0 +1,72 @@
+import collections
+import threading
+import numpy as np
+import metrics
+
+
+buffer_hits = metrics.counter('asr_input_buffer_hits_total', 'Acoustic model batches that reused a cached input buffer')
+buffer_misses = metrics.counter('asr_input_buffer_misses_total',
+                                'Acoustic model batches that allocated a new input buffer')
+buffer_evictions = metrics.counter('asr_input_buffer_evictions_total',
+                                   'Input buffers freed to stay under the memory cap')
+buffer_memory = metrics.gauge('asr_input_buffer_bytes', 'Memory held by input buffers')
+
+
+class InputBuffer(object):
+    # Host staging memory for a batch and, on GPU, device memory of the same size it is uploaded to
+    def __init__(self, size, gpu):
+        self.size = size
+        self.host = np.empty(size, dtype=np.uint8)
+        self.device = None
+
+        if gpu:
+            from PuzzleLib.Backend import gpuarray
+            self.device = gpuarray.empty((size, ), np.uint8)
+
+    def upload(self, batch):
+        if self.device is None:
+            from PuzzleLib.CPU.CPUArray import CPUArray
+            return CPUArray.toDevice(batch)
+
+        from PuzzleLib.Backend import gpuarray
+        inputs = gpuarray.empty(batch.shape, batch.dtype, gpudata=self.device.gpudata)
+        inputs.set(batch)
+
+        return inputs
+
+
+class InputBufferPool(object):
+    # Buffers are bucketed by power of two sizes, free buffers are evicted in least recently used order
+    # when the memory of all buffers exceeds the cap
+    def __init__(self, gpu, memory_cap, min_size=1 << 20):
+        self.gpu, self.memory_cap, self.min_size = gpu, memory_cap, min_size
+        self.free = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, nbytes):
+        size = max(self.min_size, 1 << (nbytes - 1).bit_length())
+
+        with self.lock:
+            for key, buffer in self.free.items():
+                if buffer.size == size:
+                    del self.free[key]
+                    buffer_hits.inc()
+                    return buffer
+
+            self.size += size
+            buffer_memory.set(self.size)
+
+        buffer_misses.inc()
+        return InputBuffer(size, self.gpu)
+
+    def release(self, buffer):
+        with self.lock:
+            self.free[id(buffer)] = buffer
+
+            while self.size > self.memory_cap and len(self.free) > 0:
+                _, evicted = self.free.popitem(last=False)
+                self.size -= evicted.size
+                buffer_evictions.inc()
+
+            buffer_memory.set(self.size)
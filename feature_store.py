@@ -0,0 +1,154 @@
+import os
+import json
+import hashlib
+import argparse
+import configparser
+import numpy as np
+from data_loader import preprocess
+
+
+class FeatureStore(object):
+    # Spectrograms of a manifest are kept in raw shard files, each one as a contiguous (freq, time) block,
+    # the index holds the shard, element offset and frame count of every sample
+    def __init__(self, folder, index):
+        self.folder, self.index = folder, index
+        self.dtype = np.dtype(index['dtype'])
+        self.freq_size = index['freq_size']
+        self.shards = [self.open_shard(os.path.join(folder, shard)) for shard in index['shards']]
+
+    def open_shard(self, path):
+        # Empty files can't be memory-mapped
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(path, dtype=self.dtype, mode='r')
+
+    def __getitem__(self, i):
+        shard, offset, frames = self.index['items'][i]
+        return self.shards[shard][offset:offset + self.freq_size * frames].reshape((self.freq_size, frames))
+
+    def __len__(self):
+        return len(self.index['items'])
+
+
+def get_store_key(manifest_file_path, sample_rate, window_size, window_stride, dtype):
+    # Features depend on the manifest, the size and modification time of its audio files
+    # and the feature extraction parameters
+    key = hashlib.sha1('{}:{}:{}:{}\n'.format(sample_rate, window_size, window_stride, np.dtype(dtype).str).encode())
+    with open(manifest_file_path, 'rb') as f:
+        manifest = f.read()
+    key.update(manifest)
+
+    for line in manifest.decode().splitlines():
+        if not line.strip():
+            continue
+        audio_path = line.strip().split(',')[0]
+        stat = os.stat(audio_path)
+        key.update('{}:{}:{}\n'.format(audio_path, stat.st_size, stat.st_mtime_ns).encode())
+
+    return key.hexdigest()
+
+
+def open_feature_store(folder, key):
+    try:
+        with open(os.path.join(folder, 'index.json'), encoding='UTF-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if index.get('key') != key:
+        return None
+
+    return FeatureStore(folder, index)
+
+
+def build_feature_store(manifest_file_path, folder, sample_rate, window_size, window_stride, dtype=np.float32,
+                        shard_size=1 << 30):
+    dtype = np.dtype(dtype)
+    key = get_store_key(manifest_file_path, sample_rate, window_size, window_stride, dtype)
+
+    with open(manifest_file_path) as f:
+        samples = [line.strip().split(',') for line in f]
+
+    os.makedirs(folder, exist_ok=True)
+    for name in os.listdir(folder):
+        if name.startswith('shard_') and name.endswith('.bin'):
+            os.remove(os.path.join(folder, name))
+
+    index = {'key': key, 'dtype': dtype.str, 'freq_size': 1 + int(sample_rate * window_size) // 2,
+             'shards': [], 'items': []}
+    shard_file, shard_offset = None, 0
+
+    try:
+        for i, sample in enumerate(samples):
+            spectrogram = preprocess(sample[0], sample_rate, window_size, window_stride).astype(dtype)
+
+            full = shard_offset > 0 and (shard_offset + spectrogram.size) * dtype.itemsize > shard_size
+            if shard_file is None or full:
+                if shard_file is not None:
+                    shard_file.close()
+                index['shards'].append('shard_{:04d}.bin'.format(len(index['shards'])))
+                shard_file, shard_offset = open(os.path.join(folder, index['shards'][-1]), 'wb'), 0
+
+            shard_file.write(np.ascontiguousarray(spectrogram).tobytes())
+            index['items'].append([len(index['shards']) - 1, shard_offset, spectrogram.shape[1]])
+            shard_offset += spectrogram.size
+
+            if (i + 1) % 1000 == 0:
+                print('Extracted features of {} of {} files'.format(i + 1, len(samples)))
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+
+    # The index is written last, an interrupted extraction leaves the store invalid
+    tmp_path = os.path.join(folder, 'index.json.tmp')
+    with open(tmp_path, 'w', encoding='UTF-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(folder, 'index.json'))
+
+    return FeatureStore(folder, index)
+
+
+def get_feature_store(manifest_file_path, folder, sample_rate, window_size, window_stride, dtype=np.float32,
+                      shard_size=1 << 30):
+    # Opens the store of the manifest, features are extracted again when it is missing or stale
+    key = get_store_key(manifest_file_path, sample_rate, window_size, window_stride, dtype)
+    store = open_feature_store(folder, key)
+
+    if store is None:
+        print('Extracting features of {} to {}'.format(manifest_file_path, folder))
+        store = build_feature_store(manifest_file_path, folder, sample_rate, window_size, window_stride, dtype,
+                                    shard_size)
+
+    return store
+
+
+def get_store_folder(feature_cache, manifest_file_path):
+    # Manifests with the same name in different folders get their own stores
+    path_hash = hashlib.sha1(os.path.abspath(manifest_file_path).encode()).hexdigest()[:8]
+    return os.path.join(feature_cache, '{}-{}'.format(os.path.splitext(os.path.basename(manifest_file_path))[0],
+                                                      path_hash))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Feature extraction for training')
+    parser.add_argument('--config', default='config.ini', help='Path to config')
+    parser.add_argument('--manifest', nargs='+', required=True, help='Manifest csv files')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config, encoding='UTF-8')
+
+    sample_rate = int(config['Wav2Letter'].get('sample_rate'))
+    window_size = float(config['Wav2Letter'].get('window_size'))
+    window_stride = float(config['Wav2Letter'].get('window_stride'))
+    feature_cache = config['Train'].get('feature_cache', 'data/features')
+    feature_dtype = config['Train'].get('feature_dtype', 'float32')
+    shard_size = int(float(config['Train'].get('feature_shard_size', 1024)) * 2 ** 20)
+
+    for manifest in args.manifest:
+        get_feature_store(manifest, get_store_folder(feature_cache, manifest), sample_rate, window_size,
+                          window_stride, feature_dtype, shard_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,46 +1,137 @@
+import io
 import os
-import subprocess
 import time
 import logging
 import uuid
-from speech_recognizer import SpeechRecognizer
-from punctuator import Punctuator
-from number_utils.text2numbers import TextToNumbers
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from audio_decoder import AudioDecoder, save_wav
+from jobs import JobQueue
+from model_server import ModelClient, ModelPipeline
+from result_cache import ResultCache, get_config_fingerprint
 
 
-speech_recognizer = SpeechRecognizer()
-punctuator = Punctuator(model_path="data/punctuator")
-text2numbers = TextToNumbers()
+config = configparser.ConfigParser()
+config.read('config.ini', encoding='UTF-8')
+sample_rate = int(config['Wav2Letter']['sample_rate'])
+save_records = int(config['Server'].get('save_records', 1))
+audio_decoder = AudioDecoder(sample_rate, int(config['Server'].get('decoder_workers', 4)))
+record_writer = ThreadPoolExecutor(max_workers=1)
+decode_latency = metrics.histogram('asr_audio_decode_seconds', 'Time spent decoding uploaded audio files')
+
+if int(config['Server'].get('model_server', 0)):
+    models = ModelClient(config['Server'].get('model_server_address', '/tmp/sova-asr.sock'),
+                         config['Server'].get('model_server_authkey', 'sova-asr').encode())
+else:
+    models = ModelPipeline('config.ini')
+
+if int(config['Server'].get('preload_models', 1)):
+    models.preload()
+
+result_cache = None
+if int(config['Server'].get('result_cache_size', 0)) > 0 or config['Server'].get('result_cache_folder', ''):
+    result_cache = ResultCache(get_config_fingerprint(config), int(config['Server'].get('result_cache_size', 0)),
+                               config['Server'].get('result_cache_folder', ''),
+                               float(config['Server'].get('result_cache_disk_size', 1024)) * 2 ** 20)
+
+job_queue = JobQueue(lambda blobs: FileHandler.get_recognized_texts(blobs), int(config['Server'].get('job_workers', 2)),
+                     int(config['Server'].get('max_jobs', 16)), float(config['Server'].get('job_ttl', 3600)))
 
 
 class FileHandler:
     @staticmethod
     def get_recognized_text(blob):
+        return FileHandler.get_recognized_texts([blob])[0]
+
+    @staticmethod
+    def get_recognized_texts(blobs):
+        responses = [None] * len(blobs)
+        timings = [{} for _ in blobs]
+        decoded = []
+
+        with ThreadPoolExecutor(max_workers=max(1, min(len(blobs), os.cpu_count() or 1))) as executor:
+            futures = [
+                executor.submit(FileHandler.decode, blob, blob_timings) for blob, blob_timings in zip(blobs, timings)
+            ]
+
+            for i, future in enumerate(futures):
+                try:
+                    new_filename, audio = future.result()
+                    decoded.append((i, new_filename, audio))
+                except Exception as e:
+                    logging.exception(e)
+                    responses[i] = (1, None, str(e))
+
+        if len(decoded) > 0:
+            try:
+                models_results = FileHandler.get_models_results([audio for _, _, audio in decoded])
+                for (i, new_filename, _), response_models_result in zip(decoded, models_results):
+                    if isinstance(response_models_result, Exception):
+                        responses[i] = (1, None, str(response_models_result))
+                        continue
+                    FileHandler.add_timings(response_models_result, timings[i])
+                    responses[i] = (0, new_filename, response_models_result)
+            except Exception as e:
+                logging.exception(e)
+                for i, _, _ in decoded:
+                    responses[i] = (1, None, str(e))
+
+        return responses
+
+    @staticmethod
+    def submit_job(blobs):
+        # Uploads are read before the request ends, they are decoded and recognized by the job queue
+        return job_queue.submit([io.BytesIO(blob.read()) for blob in blobs])
+
+    @staticmethod
+    def get_job(job_id, wait=0.0):
+        return job_queue.get(job_id, wait)
+
+    @staticmethod
+    def add_timings(response_models_result, timings):
+        # Stage timings are only present in model results when request_timings is enabled
+        for result in response_models_result:
+            if 'timings' in result:
+                result['timings'].update((stage, round(value, 4)) for stage, value in timings.items())
+
+    @staticmethod
+    def get_stream_results(chunks):
+        return models.get_stream_results(chunks)
+
+    @staticmethod
+    def get_models_status():
+        # Returns the state of every model component and whether all of them are loaded
         try:
-            filename = str(uuid.uuid4())
-            os.makedirs('./records', exist_ok=True)
-            new_record_path = os.path.join('./records', filename + '.webm')
-            blob.save(new_record_path)
-            new_filename = filename + '.wav'
-            converted_record_path = FileHandler.convert_to_wav(new_record_path, new_filename)
-            response_models_result = FileHandler.get_models_result(converted_record_path)
-            return 0, new_filename, response_models_result
+            status = models.status()
         except Exception as e:
-            logging.exception(e)
-            return 1,  None, str(e)
+            return {'ready': False, 'error': str(e)}
+
+        return {'ready': all(state == 'loaded' for state in status.values()), 'models': status}
+
+    @staticmethod
+    def render_metrics():
+        return metrics.registry.render() + models.render_metrics()
 
     @staticmethod
-    def convert_to_wav(webm_full_filepath, new_filename):
-        converted_record_path = os.path.join('./records', new_filename)
-        subprocess.call('ffmpeg -i {0} -ar 16000 -b:a 256k -ac 1 -sample_fmt s16 {1}'.format(
-                webm_full_filepath, converted_record_path
-            ),
-            shell=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-        os.remove(webm_full_filepath)
-        return converted_record_path
+    def decode(blob, timings=None):
+        with metrics.timed(decode_latency, timings, 'audio_decode'):
+            audio = audio_decoder.decode(blob.read())
+        new_filename = None
+
+        if save_records:
+            new_filename = str(uuid.uuid4()) + '.wav'
+            record_writer.submit(FileHandler.save_record, new_filename, audio)
+
+        return new_filename, audio
+
+    @staticmethod
+    def save_record(new_filename, audio):
+        try:
+            os.makedirs('./records', exist_ok=True)
+            save_wav(os.path.join('./records', new_filename), audio, sample_rate)
+        except Exception as e:
+            logging.exception(e)
 
     @staticmethod
     def check_format(files):
@@ -52,19 +143,37 @@ class FileHandler:
         return True
 
     @staticmethod
-    def get_models_result(converted_record_path, delimiter='<br>'):
-        results = []
-        start = time.time()
-        decoder_result = speech_recognizer.recognize(converted_record_path)
-        text = punctuator.predict(decoder_result.text)
-        text = text2numbers.convert(text)
-        end = time.time()
-        results.append(
-            {
-                'text': text,
-                'time': round(end - start, 3),
-                'confidence': decoder_result.score,
-                'words': decoder_result.words
-            }
-        )
+    def get_models_result(audio, delimiter='<br>'):
+        result = FileHandler.get_models_results([audio], delimiter)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    @staticmethod
+    def get_models_results(audios, delimiter='<br>'):
+        # Audios that failed get their exception in place of the result
+        if result_cache is None:
+            return models.get_models_results(audios)
+
+        # Audios recognized before with the same models are answered from the cache without running them
+        keys, results = [], []
+        for audio in audios:
+            start = time.time()
+            keys.append(result_cache.key(audio))
+            result = result_cache.get(keys[-1])
+
+            # The time of a cached result is the time of the lookup
+            if result is not None:
+                for item in result:
+                    item['time'] = round(time.time() - start, 3)
+            results.append(result)
+
+        missing = [i for i, result in enumerate(results) if result is None]
+
+        if len(missing) > 0:
+            for i, result in zip(missing, models.get_models_results([audios[i] for i in missing])):
+                if not isinstance(result, Exception):
+                    result_cache.put(keys[i], result)
+                results[i] = result
+
         return results
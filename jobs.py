@@ -0,0 +1,153 @@
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+
+active_jobs = metrics.gauge('asr_jobs_active', 'Recognition jobs queued or running in this web worker')
+rejected_jobs = metrics.counter('asr_jobs_rejected_total', 'Recognition jobs rejected because the job queue was full')
+
+
+class Job(object):
+    def __init__(self, blobs):
+        self.id = uuid.uuid4().hex
+        self.blobs = blobs
+        self.status, self.result = 'queued', None
+        self.finish_time = None
+        self.done = threading.Event()
+
+    def state(self):
+        return {'job_id': self.id, 'status': self.status, 'result': self.result}
+
+
+class JobQueue(object):
+    # Jobs run in a bounded pool of threads of the web worker that accepted them, their state is also written
+    # to the jobs folder so that any web worker can answer for a job
+    def __init__(self, process, workers=2, max_jobs=16, ttl=3600, folder='./jobs'):
+        self.process = process
+        self.max_jobs, self.ttl, self.folder = max_jobs, ttl, folder
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.jobs, self.active = {}, 0
+        self.lock = threading.Lock()
+        self.sweep_time = 0.0
+
+    def submit(self, blobs):
+        # Returns None when the queue is full
+        self.sweep()
+
+        with self.lock:
+            self.expire()
+
+            if self.active >= self.max_jobs:
+                rejected_jobs.inc()
+                return None
+
+            job = Job(blobs)
+            self.jobs[job.id] = job
+            self.active += 1
+            active_jobs.set(self.active)
+
+        self.save(job)
+        self.executor.submit(self.run, job)
+
+        return job.id
+
+    def run(self, job):
+        job.status = 'running'
+        self.save(job)
+
+        try:
+            job.result = self.process(job.blobs)
+            job.status = 'done'
+        except Exception as e:
+            logging.exception(e)
+            job.status, job.result = 'error', str(e)
+
+        job.blobs, job.finish_time = None, time.time()
+
+        with self.lock:
+            self.active -= 1
+            active_jobs.set(self.active)
+
+        self.save(job)
+        job.done.set()
+
+    def get(self, job_id, wait=0.0):
+        # Waits up to wait seconds for the job to finish, returns None for unknown jobs
+        self.sweep()
+
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.done.wait(wait)
+            return job.state()
+
+        # Jobs of other web workers are polled through their state files
+        deadline = time.time() + wait
+        while True:
+            state = self.load(job_id)
+            if state is None or state['status'] in ('done', 'error') or time.time() >= deadline:
+                return state
+            time.sleep(min(0.5, max(0.0, deadline - time.time())))
+
+    def expire(self):
+        now = time.time()
+        for job in list(self.jobs.values()):
+            if job.finish_time is not None and now - job.finish_time > self.ttl:
+                del self.jobs[job.id]
+                try:
+                    os.remove(self.path(job.id))
+                except OSError:
+                    pass
+
+    def sweep(self, interval=60.0):
+        # State files left by restarted or other web workers are removed by their age,
+        # files of jobs that are still running here are kept
+        now = time.time()
+        with self.lock:
+            if now - self.sweep_time < min(interval, self.ttl):
+                return
+            self.sweep_time = now
+            running = set(job.id + '.json' for job in self.jobs.values() if job.finish_time is None)
+
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return
+
+        for name in names:
+            if name in running or not name.endswith(('.json', '.tmp')):
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def path(self, job_id):
+        return os.path.join(self.folder, job_id + '.json')
+
+    def save(self, job):
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp_path = self.path(job.id) + '.tmp'
+            with open(tmp_path, 'w', encoding='UTF-8') as f:
+                json.dump(job.state(), f, ensure_ascii=False)
+            os.replace(tmp_path, self.path(job.id))
+        except OSError as e:
+            logging.exception(e)
+
+    def load(self, job_id):
+        if re.fullmatch('[0-9a-f]{32}', job_id) is None:
+            return None
+
+        try:
+            with open(self.path(job_id), encoding='UTF-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
@@ -0,0 +1,148 @@
+import bisect
+import contextlib
+import threading
+import time
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation = name, documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise Exception('Expected labels {} for metric {}, got {}'.format(self.labelnames, self.name, list(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if len(pairs) == 0:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, value) for name, value in pairs) + '}'
+
+    def collect(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+        with self.lock:
+            lines.extend(self.collect())
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def collect(self):
+        return ['{}{} {}'.format(self.name, self.format_labels(key), value) for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def collect(self):
+        return ['{}{} {}'.format(self.name, self.format_labels(key), value) for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def collect(self):
+        lines = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, self.format_labels(key, [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self.format_labels(key), total))
+            lines.append('{}_count{} {}'.format(self.name, self.format_labels(key), cumulative))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                return self.metrics[metric.name]
+            self.metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        # Metrics without samples are left out, so that a process only exposes the metrics it records
+        with self.lock:
+            metrics = [metric for metric in self.metrics.values() if len(metric.values) > 0]
+        return ''.join(line + '\n' for metric in metrics for line in metric.render())
+
+
+registry = Registry()
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64]
+
+
+def counter(name, documentation, labelnames=()):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return registry.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, buckets=LATENCY_BUCKETS, labelnames=()):
+    return registry.register(Histogram(name, documentation, buckets, labelnames))
+
+
+stage_latency = histogram('asr_stage_seconds', 'Time spent in each stage of the recognition pipeline',
+                          labelnames=('stage', ))
+
+
+@contextlib.contextmanager
+def timed(metric, timings=None, key=None, **labels):
+    # Observes the duration of the block, and adds it to timings under key (the stage label by default)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metric.observe(elapsed, **labels)
+
+        if timings is not None:
+            key = labels['stage'] if key is None else key
+            timings[key] = timings.get(key, 0.0) + elapsed
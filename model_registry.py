@@ -0,0 +1,53 @@
+import time
+import logging
+import threading
+import collections
+import metrics
+
+
+load_time = metrics.gauge('asr_model_load_seconds', 'Time it took to load a model component', labelnames=('component', ))
+
+
+class ModelRegistry(object):
+    # Components are built by their factories on first use, or all at once in a background thread by preload
+    def __init__(self):
+        self.factories, self.locks = collections.OrderedDict(), {}
+        self.models, self.states = {}, {}
+
+    def register(self, name, factory):
+        self.factories[name] = factory
+        self.locks[name] = threading.Lock()
+        self.states[name] = 'not loaded'
+
+    def get(self, name):
+        if name in self.models:
+            return self.models[name]
+
+        with self.locks[name]:
+            if name not in self.models:
+                self.states[name] = 'loading'
+                start = time.perf_counter()
+
+                try:
+                    self.models[name] = self.factories[name]()
+                except Exception as e:
+                    self.states[name] = 'error: {}'.format(e)
+                    raise
+
+                load_time.set(time.perf_counter() - start, component=name)
+                self.states[name] = 'loaded'
+
+        return self.models[name]
+
+    def preload(self):
+        threading.Thread(target=self.load_all, name='model-loader', daemon=True).start()
+
+    def load_all(self):
+        for name in self.factories:
+            try:
+                self.get(name)
+            except Exception as e:
+                logging.exception(e)
+
+    def status(self):
+        return dict(self.states)
@@ -0,0 +1,326 @@
+import os
+import logging
+import argparse
+import threading
+import configparser
+from multiprocessing.connection import Client, Listener
+import metrics
+from model_registry import ModelRegistry
+
+
+audio_seconds = metrics.counter('asr_audio_seconds_total', 'Seconds of audio recognized')
+real_time_factor = metrics.histogram('asr_real_time_factor', 'Processing time divided by audio duration',
+                                     buckets=[0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0])
+
+
+class ModelPipeline(object):
+    # Models are loaded on first use, preload loads them in a background thread right away
+    def __init__(self, config_path='config.ini'):
+        self.config_path = config_path
+        self.config = configparser.ConfigParser()
+        self.config.read(config_path, encoding='UTF-8')
+
+        # The spawner of the decoder processes is forked here, while the process has no other threads that could
+        # hold a lock in the forked copy, the decoder itself is built in it when the decoder component is loaded
+        from decoder import start_decode_pool
+        self.decode_pool = start_decode_pool(self.config)
+
+        self.sample_rate = int(self.config['Wav2Letter']['sample_rate'])
+        self.request_timings = int(self.config['Server'].get('request_timings', 0))
+        self.punctuator_lock = threading.Lock()
+        self.backend_lock, self.backend_ready = threading.Lock(), False
+
+        self.registry = ModelRegistry()
+        self.registry.register('decoder', self.load_decoder)
+        self.registry.register('speech_recognizer', self.load_speech_recognizer)
+        self.registry.register('scheduler', self.load_scheduler)
+        self.registry.register('punctuator', self.load_punctuator)
+        self.registry.register('text2numbers', self.load_text2numbers)
+
+    @property
+    def speech_recognizer(self):
+        return self.registry.get('speech_recognizer')
+
+    @property
+    def scheduler(self):
+        return self.registry.get('scheduler')
+
+    @property
+    def punctuator(self):
+        return self.registry.get('punctuator')
+
+    @property
+    def text2numbers(self):
+        return self.registry.get('text2numbers')
+
+    def setup_backend(self):
+        # The backend is chosen before the model modules import PuzzleLib
+        with self.backend_lock:
+            if not self.backend_ready and int(self.config['Wav2Letter']['cpu']):
+                from cpu_backend import setup_cpu_backend
+                setup_cpu_backend(int(self.config['Wav2Letter'].get('cpu_threads', 0)))
+            self.backend_ready = True
+
+    def load_decoder(self):
+        if self.decode_pool is not None:
+            return self.decode_pool.start()
+
+        from decoder import load_decoder
+        return load_decoder(self.config)
+
+    def load_speech_recognizer(self):
+        decoder = self.registry.get('decoder')
+        self.setup_backend()
+        from speech_recognizer import SpeechRecognizer
+        return SpeechRecognizer(self.config_path, decoder, self.decode_pool)
+
+    def load_scheduler(self):
+        from batch_scheduler import BatchScheduler
+        return BatchScheduler(self.speech_recognizer, int(self.config['Server'].get('max_batch_size', 16)),
+                              float(self.config['Server'].get('max_batch_wait', 10)) / 1000)
+
+    def load_punctuator(self):
+        self.setup_backend()
+        from punctuator import Punctuator
+        return Punctuator(self.config['Punctuator'].get('model_path', 'data/punctuator'),
+                          int(self.config['Punctuator'].get('batch_size', 64)),
+                          self.config['Wav2Letter'].get('shared_weights', ''))
+
+    @staticmethod
+    def load_text2numbers():
+        from number_utils.text2numbers import TextToNumbers
+        return TextToNumbers()
+
+    def preload(self):
+        self.registry.preload()
+
+    def status(self):
+        return self.registry.status()
+
+    def get_models_results(self, audios):
+        # Every audio gets a list with its result, or an exception when it failed, failures of one audio
+        # do not affect the others
+        timings = [{} for _ in audios]
+        decoder_results = self.speech_recognizer.recognize_batch(audios, timings, self.scheduler.forward)
+        recognized = [i for i, result in enumerate(decoder_results) if not isinstance(result, Exception)]
+
+        punctuation_timings = {}
+        with self.punctuator_lock:
+            with metrics.timed(metrics.stage_latency, punctuation_timings, stage='punctuation'):
+                texts = self.punctuate([decoder_results[i].text for i in recognized])
+
+        results = [Exception(str(decoder_result)) if isinstance(decoder_result, Exception) else None
+                   for decoder_result in decoder_results]
+
+        for i, text in zip(recognized, texts):
+            decoder_result, audio_timings = decoder_results[i], timings[i]
+            if isinstance(text, Exception):
+                results[i] = Exception(str(text))
+                continue
+
+            audio_timings.update(punctuation_timings)
+            try:
+                with metrics.timed(metrics.stage_latency, audio_timings, stage='text2numbers'):
+                    text = self.text2numbers.convert(text)
+            except Exception as e:
+                logging.exception(e)
+                results[i] = Exception(str(e))
+                continue
+
+            # Audios are processed together, the time of an audio is the sum of its own stages
+            elapsed = sum(audio_timings.values())
+            duration = len(audios[i]) / self.sample_rate
+            audio_seconds.inc(duration)
+            if duration > 0:
+                real_time_factor.observe(elapsed / duration)
+
+            result = {
+                'text': text,
+                'time': round(elapsed, 3),
+                'confidence': decoder_result.score,
+                'words': decoder_result.words
+            }
+            if self.request_timings:
+                result['timings'] = {stage: round(value, 4) for stage, value in audio_timings.items()}
+            results[i] = [result]
+
+        return results
+
+    def punctuate(self, texts):
+        # When the batch fails, texts are punctuated one by one and the ones that still fail get their exceptions
+        try:
+            return self.punctuator.predict_batch(texts)
+        except Exception as e:
+            logging.exception(e)
+
+        results = []
+        for text in texts:
+            try:
+                results.append(self.punctuator.predict(text))
+            except Exception as e:
+                results.append(e)
+
+        return results
+
+    @staticmethod
+    def render_metrics():
+        # Metrics of an in-process pipeline are already in the local registry
+        return ''
+
+    def get_stream_results(self, chunks):
+        for decoder_result in self.speech_recognizer.recognize_stream(chunks, self.scheduler.forward):
+            yield {
+                'text': decoder_result.text,
+                'confidence': decoder_result.score,
+                'words': decoder_result.words
+            }
+
+
+class ModelServer(object):
+    def __init__(self, pipeline, address, authkey):
+        self.pipeline = pipeline
+        self.address, self.authkey = address, authkey
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+        with Listener(self.address, family='AF_UNIX', authkey=self.authkey) as listener:
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    logging.exception(e)
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    method, args = conn.recv()
+                except EOFError:
+                    return
+
+                try:
+                    if method == 'get_models_results':
+                        conn.send(('ok', self.pipeline.get_models_results(args)))
+                    elif method == 'get_stream_results':
+                        self.handle_stream(conn)
+                    elif method == 'render_metrics':
+                        conn.send(('ok', metrics.registry.render()))
+                    elif method == 'status':
+                        conn.send(('ok', self.pipeline.status()))
+                    else:
+                        raise Exception('Unknown model server method: {}'.format(method))
+                except (EOFError, OSError) as e:
+                    # A client that goes away in the middle of a stream leaves nothing to answer
+                    if method == 'get_stream_results':
+                        return
+                    logging.exception(e)
+                    conn.send(('error', str(e)))
+                except Exception as e:
+                    logging.exception(e)
+                    conn.send(('error', str(e)))
+
+    def handle_stream(self, conn):
+        # The client sends audio chunks one by one and a None after the last one,
+        # every chunk is answered with the partial results it produced
+        results = []
+
+        def chunks():
+            while True:
+                chunk = conn.recv()
+                if chunk is None:
+                    return
+                yield chunk
+                conn.send(('partial', results[:]))
+                del results[:]
+
+        for result in self.pipeline.get_stream_results(chunks()):
+            results.append(result)
+
+        conn.send(('ok', results))
+
+
+class ModelClient(object):
+    def __init__(self, address, authkey):
+        self.address, self.authkey = address, authkey
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or conn.closed:
+            conn = self.local.conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+        return conn
+
+    def call(self, method, args):
+        conn = self.connection()
+        try:
+            conn.send((method, args))
+            return self.receive(conn)
+        except (EOFError, OSError):
+            conn.close()
+            raise
+
+    @staticmethod
+    def receive(conn):
+        status, value = conn.recv()
+        if status == 'error':
+            raise Exception(value)
+        return value
+
+    def get_models_results(self, audios):
+        return self.call('get_models_results', audios)
+
+    def render_metrics(self):
+        return self.call('render_metrics', None)
+
+    def status(self):
+        return self.call('status', None)
+
+    def preload(self):
+        # Models are loaded by the model server
+        pass
+
+    def get_stream_results(self, chunks):
+        # Until the final results arrive the server reads everything sent on the connection as audio chunks,
+        # so a stream that does not finish cleanly leaves a connection that can't be reused and it is closed
+        conn = self.connection()
+        finished = False
+        try:
+            conn.send(('get_stream_results', None))
+            for chunk in chunks:
+                conn.send(chunk)
+                for result in self.receive(conn):
+                    yield result
+            conn.send(None)
+            results = self.receive(conn)
+            finished = True
+            for result in results:
+                yield result
+        finally:
+            if not finished:
+                conn.close()
+                self.local.conn = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Model server')
+    parser.add_argument('--config', default='config.ini', help='Path to config')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config, encoding='UTF-8')
+
+    pipeline = ModelPipeline(args.config)
+    if int(config['Server'].get('preload_models', 1)):
+        pipeline.preload()
+
+    server = ModelServer(pipeline, config['Server'].get('model_server_address', '/tmp/sova-asr.sock'),
+                         config['Server'].get('model_server_authkey', 'sova-asr').encode())
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
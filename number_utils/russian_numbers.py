@@ -457,8 +457,22 @@ class RussianNumbers:
             "триллионом": Numeral(1000000000000, 7, True)
         }
 
+        self.fraction_words = {
+            "целых", "целой", "целым", "целая",
+            "десятых", "десятой", "десятым", "десятая",
+            "сотых", "сотой", "сотым", "сотая",
+            "тысячных", "тысячной", "тысячным", "тысячная",
+            "десятитысячных", "десятитысячной", "десятитысячным", "десятитысячная"
+        }
+
+        # Every word that can start a number, text without any of them is returned unchanged by parse
+        self.vocabulary = frozenset(self.tokens) | frozenset(self.tokens_fractions) | frozenset(self.fraction_words)
+
         self.max_token_error = 0.3
 
+    def contains_numerals(self, raw_token_list):
+        return any(raw_token.strip(string.punctuation) in self.vocabulary for raw_token in raw_token_list)
+
     def get_token_sum_error_from_lists(self, token):
         token_sum_error = 0
 
@@ -471,7 +485,7 @@ class RussianNumbers:
 
         return token_sum_error
 
-    def parse_tokens(self, text_line, matrix_d, level, fraction=False):
+    def parse_tokens(self, text_line, level, fraction=False):
         if text_line in self.tokens.keys():
             return [NumericToken(self.tokens[text_line])]
         elif fraction:
@@ -485,10 +499,6 @@ class RussianNumbers:
         if len(text) == 0:
             return ParserResult(value=0, error=1)
 
-        # Массив для рассчета расстояния Левенштейна
-        max_token_length = 13
-        matrix_d = np.zeros((2, max_token_length), dtype=np.float32)
-
         # Разбиваем текст на токены
         raw_token_list = re.split(r"\s+", text)
         all_token_list = []
@@ -500,7 +510,7 @@ class RussianNumbers:
         # Обрабатываем токены
         for token_idx, raw_token in enumerate(raw_token_list):
             clean_token = raw_token.strip(string.punctuation)
-            current_token_list = self.parse_tokens(clean_token, matrix_d, 0)
+            current_token_list = self.parse_tokens(clean_token, 0)
 
             # Определение дробного числа:
             if clean_token in ["целых", "целой", "целым", "целая"] and token_idx != 0:
@@ -512,7 +522,7 @@ class RussianNumbers:
                         if raw_token_list[token_idx + 2] in self.tokens_fractions \
                                 or raw_token_list[token_idx + 3] in self.tokens_fractions \
                                 or raw_token_list[token_idx + 4] in self.tokens_fractions:
-                            current_token_list = self.parse_tokens(clean_token, matrix_d, 0, fraction=True)
+                            current_token_list = self.parse_tokens(clean_token, 0, fraction=True)
 
                 except IndexError:
                     pass
@@ -521,25 +531,25 @@ class RussianNumbers:
             if clean_token in ["десятых", "десятой", "десятым", "десятая"] and token_idx != 0:
 
                 if raw_token_list[token_idx - 1] in self.tokens:
-                    current_token_list = self.parse_tokens(clean_token, matrix_d, 0, fraction=True)
+                    current_token_list = self.parse_tokens(clean_token, 0, fraction=True)
 
             # Обработка второго порядка:
             if clean_token in ["сотых", "сотой", "сотым", "сотая"] and token_idx != 0:
 
                 if raw_token_list[token_idx - 1] in self.tokens:
-                    current_token_list = self.parse_tokens(clean_token, matrix_d, 0, fraction=True)
+                    current_token_list = self.parse_tokens(clean_token, 0, fraction=True)
 
             # Обработка третьего порядка:
             if clean_token in ["тысячных", "тысячной", "тысячным", "тысячная"] and token_idx != 0:
 
                 if raw_token_list[token_idx - 1] in self.tokens:
-                    current_token_list = self.parse_tokens(clean_token, matrix_d, 0, fraction=True)
+                    current_token_list = self.parse_tokens(clean_token, 0, fraction=True)
 
             # Обработка четвёртого порядка:
             if clean_token in ["десятитысячных", "десятитысячной", "десятитысячным", "десятитысячная"] and token_idx != 0:
 
                 if raw_token_list[token_idx - 1] in self.tokens:
-                    current_token_list = self.parse_tokens(clean_token, matrix_d, 0, fraction=True)
+                    current_token_list = self.parse_tokens(clean_token, 0, fraction=True)
 
             if raw_token == "тысяча":
                 if token_idx == 0 or raw_token_list[token_idx - 1] != "одна":
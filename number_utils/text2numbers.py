@@ -2,6 +2,9 @@ from number_utils.russian_numbers import RussianNumbers
 import numpy as np
 
 
+DIGITS = frozenset("0123456789")
+
+
 class TextToNumbers:
     def __init__(self):
         self.russian_numbers = RussianNumbers()
@@ -10,22 +13,25 @@ class TextToNumbers:
         if not text_line:
             return text_line
 
+        # Without number words and digits parsing and postprocessing only lowercase the text
+        # and collapse whitespace
+        raw_token_list = text_line.strip().lower().split()
+        if not self.russian_numbers.contains_numerals(raw_token_list) and DIGITS.isdisjoint(text_line):
+            return " ".join(raw_token_list)
+
         parsed_list, result_text_list = self.russian_numbers.parse(text=text_line)
-        converted_text = ""
+        converted_list = []
         parsed_idx = 0
-        result_text_list_len = len(result_text_list)
 
-        for i, element in enumerate(result_text_list):
+        for element in result_text_list:
             if element == "":
-                converted_text += str(parsed_list[parsed_idx].value)
+                converted_list.append(str(parsed_list[parsed_idx].value))
                 parsed_idx += 1
 
             else:
-                converted_text += element
-
-            if i < result_text_list_len - 1:
-                converted_text += " "
+                converted_list.append(element)
 
+        converted_text = " ".join(converted_list)
         converted_text = self.float_postprocessing(converted_text)
 
         return converted_text
@@ -33,76 +39,18 @@ class TextToNumbers:
     @staticmethod
     def float_postprocessing(converted_text):
         if "минус" in converted_text and " и " not in converted_text:
-            for x in ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9"]:
-                if x in converted_text:
-                    converted_text = converted_text.replace("минус ", "-")
+            if not DIGITS.isdisjoint(converted_text):
+                converted_text = converted_text.replace("минус ", "-")
 
         if "точка" in converted_text:
-            try:
-                for idx, val in enumerate(converted_text):
-                    if val == "т":
-                        if converted_text[idx + 4] == "а" \
-                                and converted_text[idx - 2] in ["0", "1", "2", "3", "4",
-                                                                "5", "6", "7", "8", "9"] \
-                                and converted_text[idx + 6] in ["0", "1", "2", "3", "4",
-                                                                "5", "6", "7", "8", "9"] \
-                                and "0." in converted_text[idx + 6:]:
-                            converted_text = converted_text.replace(" точка ", ".").replace("0.", "")
-                        if converted_text[idx + 4] == "а" \
-                                and converted_text[idx - 2] in ["0", "1", "2", "3", "4",
-                                                                "5", "6", "7", "8", "9"] \
-                                and converted_text[idx + 6] in ["0", "1", "2", "3", "4",
-                                                                "5", "6", "7", "8", "9"] \
-                                and "0." not in converted_text[idx + 6:]:
-                            converted_text = converted_text.replace(" точка ", ".")
-
-            except IndexError:
-                pass
+            converted_text = TextToNumbers.join_separator(converted_text, "точка")
 
         if "запятая" in converted_text:
-            try:
-                for idx, val in enumerate(converted_text):
-                    if val == "з":
-                        if converted_text[idx + 6] == "я" \
-                                and converted_text[idx - 2] in ["0", "1", "2", "3", "4",
-                                                                "5", "6", "7", "8", "9"] \
-                                and converted_text[idx + 8] in ["0", "1", "2", "3", "4",
-                                                                "5", "6", "7", "8", "9"] \
-                                and "0." in converted_text[idx + 8:]:
-                            converted_text = converted_text.replace(" запятая ", ".").replace("0.", "")
-                        if converted_text[idx + 6] == "я" \
-                                and converted_text[idx - 2] in ["0", "1", "2", "3", "4",
-                                                                "5", "6", "7", "8", "9"] \
-                                and converted_text[idx + 8] in ["0", "1", "2", "3", "4",
-                                                                "5", "6", "7", "8", "9"] \
-                                and "0." not in converted_text[idx + 8:]:
-                            converted_text = converted_text.replace(" запятая ", ".")
-
-            except IndexError:
-                pass
+            converted_text = TextToNumbers.join_separator(converted_text, "запятая")
 
         if " и " in converted_text:
-            try:
-                for idx, val in enumerate(converted_text):
-                    if val == "и" \
-                            and converted_text[idx + 2] in ["0", "1", "2", "3", "4",
-                                                            "5", "6", "7", "8", "9"] \
-                            and converted_text[idx - 1] == " " \
-                            and converted_text[idx - 2] in ["0", "1", "2", "3", "4",
-                                                            "5", "6", "7", "8", "9"]:
-
-                        if " 0." in converted_text:
-                            converted_text = converted_text.replace("0.", ".").replace(" и ", "")
-
-                            if "после запятой" in converted_text:
-                                converted_text = converted_text.replace(" после запятой", "")
-
-                        if "после запятой" in converted_text:
-                            converted_text = converted_text.replace(" и ", ".").replace(" после запятой", "")
-
-                        else:
-                            converted_text = converted_text.replace(" и ", ".")
-            except IndexError:
+            converted_text, finished = TextToNumbers.join_conjunction(converted_text)
+            if not finished:
                 return converted_text
 
             try:
@@ -112,6 +60,72 @@ class TextToNumbers:
 
         return converted_text
 
+    @staticmethod
+    def find_all(text, char):
+        idx = text.find(char)
+        while idx >= 0:
+            yield idx
+            idx = text.find(char, idx + 1)
+
+    @staticmethod
+    def join_separator(text, separator):
+        # "3 точка 14" becomes "3.14" and "3 точка 0.5" becomes "3.5". Positions of the first letter of the separator
+        # in the original text are checked against the current text, and a rewrite replaces all matches at once.
+        # The text is rewritten only when that changes it, and searched again only after a rewrite
+        last, digit = len(separator) - 1, len(separator) + 1
+        pattern = " {} ".format(separator)
+        zero_dot, has_pattern = text.rfind("0."), pattern in text
+
+        def matches(text, idx):
+            return text[idx + last] == separator[last] and text[idx - 2] in DIGITS and text[idx + digit] in DIGITS
+
+        try:
+            for idx in TextToNumbers.find_all(text, separator[0]):
+                if matches(text, idx) and zero_dot >= idx + digit:
+                    text = text.replace(pattern, ".").replace("0.", "")
+                    zero_dot, has_pattern = text.rfind("0."), pattern in text
+
+                if matches(text, idx) and zero_dot < idx + digit and has_pattern:
+                    text = text.replace(pattern, ".")
+                    zero_dot, has_pattern = text.rfind("0."), pattern in text
+
+        except IndexError:
+            pass
+
+        return text
+
+    @staticmethod
+    def join_conjunction(text):
+        # "3 и 5" and "3 и 0.5" become "3.5", "после запятой" after the number is dropped. Returns the text and
+        # whether it may be converted to a number, which is skipped when a match runs past the end of the text
+        def search(text):
+            return " 0." in text, " и " in text, "после запятой" in text, " после запятой" in text
+
+        has_zero, has_and, has_after, has_spaced_after = search(text)
+
+        try:
+            for idx in TextToNumbers.find_all(text, "и"):
+                if not (text[idx + 2] in DIGITS and text[idx - 1] == " " and text[idx - 2] in DIGITS):
+                    continue
+
+                if has_zero:
+                    text = text.replace("0.", ".").replace(" и ", "")
+                    if "после запятой" in text:
+                        text = text.replace(" после запятой", "")
+                    has_zero, has_and, has_after, has_spaced_after = search(text)
+
+                if has_after and (has_and or has_spaced_after):
+                    text = text.replace(" и ", ".").replace(" после запятой", "")
+                    has_zero, has_and, has_after, has_spaced_after = search(text)
+                elif not has_after and has_and:
+                    text = text.replace(" и ", ".")
+                    has_zero, has_and, has_after, has_spaced_after = search(text)
+
+        except IndexError:
+            return text, False
+
+        return text, True
+
 
 if __name__ == "__main__":
     text2numbers = TextToNumbers()
@@ -1,10 +1,11 @@
 import os
-import math
 import numpy as np
 from bert_punctuator.bert import BertPunc, BertConfig
 from bert_punctuator.tokenizer import BertTokenizer
 from PuzzleLib.Backend import gpuarray
+from PuzzleLib import Config
 from PuzzleLib.Config import getLogger
+from cpu_backend import share_weights
 import logging
 
 
@@ -13,7 +14,8 @@ logger.setLevel(logging.ERROR)
 
 
 class Punctuator(object):
-    def __init__(self, model_path="data/punctuator"):
+    def __init__(self, model_path="data/punctuator", batch_size=64, shared_weights=""):
+        self.batch_size = batch_size
         self.tokenizer = BertTokenizer(os.path.join(model_path, "vocab.txt"), lower_case=True)
         
         conf = BertConfig(os.path.join(model_path, "config.json"))
@@ -29,8 +31,27 @@ class Punctuator(object):
         
         self.bert_punctuator = BertPunc(conf)
         self.bert_punctuator.evalMode()
-        self.bert_punctuator.calcMode(np.float16)
+
+        # The CPU backend computes in float32, its weights can be shared between processes through a mapped file
+        cpu = Config.backend == Config.Backend.cpu
+        if not cpu:
+            self.bert_punctuator.calcMode(np.float16)
         self.bert_punctuator.load(os.path.join(model_path, "bert16.hdf"))
+
+        if cpu and shared_weights:
+            share_weights(self.bert_punctuator, os.path.join(model_path, "bert16.hdf"), shared_weights)
+
+        # The priming prefix is tokenized once, predictions of the windows that lie entirely
+        # inside it do not depend on the transcript and are computed only here
+        self.prefix = "берт расставляет знаки препинания в строке предсказывая токены знаков препинания. "
+        self.prefix_ids, self.prefix_token_count = self.preprocess_data(self.prefix)
+
+        prefix_ends = self.get_word_ends(self.prefix_token_count)
+        prefix_ends = prefix_ends[(prefix_ends >= (self.segment_size - 1) // 2 - 1) &
+                                  (prefix_ends <= len(self.prefix_ids) - self.segment_size // 2 - 1)]
+
+        x = self.segment(self.prefix_ids)
+        self.prefix_predictions = dict(zip(prefix_ends.tolist(), self.get_predictions(x[prefix_ends])))
         
         
     def segment(self, ids):
@@ -50,21 +71,25 @@ class Punctuator(object):
         token_count = []
         x = []
         for word in data:
-            tokens = self.tokenizer.tokenize(word)
-            ids = self.tokenizer.convert_tokens_to_ids(tokens)
+            ids = self.tokenizer.tokenize_to_ids(word)
             if len(ids) > 0:
                 x += ids
                 token_count.append([word, len(ids)])
-        x = self.segment(x)
         return x, token_count
+
+
+    @staticmethod
+    def get_word_ends(token_count):
+        return np.cumsum([k for _, k in token_count], dtype=np.int64) - 1
     
     
-    def get_predictions(self, batches):
+    def get_predictions(self, x):
         y_pred = []
-        for batch in batches:
-            inputs = gpuarray.to_gpu(batch.astype(np.int32))
+        x = x.astype(np.int32)
+        for i in range(0, x.shape[0], self.batch_size):
+            inputs = gpuarray.to_gpu(x[i:i + self.batch_size])
             output = self.bert_punctuator(inputs).get()
-            y_pred += list(output.argmax(axis=1).flatten())
+            y_pred += output.argmax(axis=1).flatten().tolist()
         return y_pred
     
     
@@ -89,13 +114,35 @@ class Punctuator(object):
     
     
     def predict(self, txt):
-        txt = "берт расставляет знаки препинания в строке предсказывая токены знаков препинания. " + txt
-        x, token_count = self.preprocess_data(txt)
-        
-        batches = np.array_split(x, math.ceil(x.shape[0] / 8), axis=0)
-        
-        y_pred = self.get_predictions(batches)
+        return self.predict_batch([txt])[0]
+
+
+    def predict_batch(self, texts):
+        if len(texts) == 0:
+            return []
+
+        # Only the windows ending a word are used, windows of all texts are packed together
+        # so that the model runs on full batches
+        data = []
+        for txt in texts:
+            ids, token_count = self.preprocess_data(txt)
+            ids, token_count = self.prefix_ids + ids, self.prefix_token_count + token_count
+
+            word_ends = self.get_word_ends(token_count)
+            word_ends = word_ends[[end not in self.prefix_predictions for end in word_ends.tolist()]]
+            data.append((len(ids), word_ends, token_count, self.segment(ids)[word_ends]))
+
+        y_pred = self.get_predictions(np.concatenate([x for _, _, _, x in data], axis=0))
+
+        preds, offset = [], 0
+        for ids_count, word_ends, token_count, _ in data:
+            y = [0] * ids_count
+            for end, pred in self.prefix_predictions.items():
+                y[end] = pred
+            for end, pred in zip(word_ends.tolist(), y_pred[offset:offset + len(word_ends)]):
+                y[end] = pred
 
-        pred = self.convert_predictions(token_count, y_pred)[83:]
+            preds.append(self.convert_predictions(token_count, y)[83:])
+            offset += len(word_ends)
 
-        return pred
+        return preds
@@ -0,0 +1,185 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import collections
+import numpy as np
+import metrics
+
+
+cache_hits = metrics.counter('asr_result_cache_hits_total', 'Recognition results served from the cache',
+                             labelnames=('tier', ))
+cache_misses = metrics.counter('asr_result_cache_misses_total', 'Recognition results not found in the cache')
+
+
+# Options that change recognition results, tuning options and the files the server writes itself at startup
+# (trie_cache, shared_weights) are left out so that they do not invalidate the disk cache
+RESULT_OPTIONS = {
+    'Wav2Letter': ('labels', 'cpu', 'greedy', 'beam_threshold', 'sample_rate', 'window_size', 'window_stride',
+                   'segment_length', 'segment_search'),
+    'Punctuator': ()
+}
+MODEL_FILES = {
+    'Wav2Letter': ('model_path', 'lm_path', 'lexicon', 'tokens'),
+    'Punctuator': ('model_path', )
+}
+
+
+def get_config_fingerprint(config):
+    # Model files and folders also add the size and modification time of their files,
+    # so that replacing a model in place invalidates the cache as well
+    fingerprint = hashlib.sha1()
+
+    for section in sorted(RESULT_OPTIONS):
+        for option in RESULT_OPTIONS[section] + MODEL_FILES[section]:
+            fingerprint.update('{}.{}={}\n'.format(section, option, config[section].get(option, '')).encode())
+
+        for option in MODEL_FILES[section]:
+            value = config[section].get(option, '')
+
+            paths = []
+            if os.path.isfile(value):
+                paths = [value]
+            elif os.path.isdir(value):
+                paths = sorted(os.path.join(value, name) for name in os.listdir(value))
+
+            for path in paths:
+                if os.path.isfile(path):
+                    stat = os.stat(path)
+                    fingerprint.update('{}:{}:{}\n'.format(path, stat.st_size, stat.st_mtime_ns).encode())
+
+    return fingerprint.hexdigest()
+
+
+class ResultCache(object):
+    # Results are kept as JSON in a memory LRU of max_items entries and, when folder is set, in files
+    # that are evicted oldest first once they take more than max_disk_size bytes
+    def __init__(self, fingerprint, max_items=1000, folder='', max_disk_size=0):
+        self.fingerprint = fingerprint
+        self.max_items, self.folder, self.max_disk_size = max_items, folder, max_disk_size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.disk_size = self.get_disk_size() if folder else 0
+
+    def key(self, audio):
+        key = hashlib.sha1(self.fingerprint.encode())
+        key.update(np.ascontiguousarray(audio).view(np.uint8))
+        return key.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+
+        tier = 'memory'
+        if value is None and self.folder:
+            value, tier = self.load(key), 'disk'
+            if value is not None:
+                self.remember(key, value)
+
+        if value is None:
+            cache_misses.inc()
+            return None
+
+        cache_hits.inc(tier=tier)
+        return json.loads(value)
+
+    def put(self, key, result):
+        # Processing time and stage timings belong to the request that computed the result, they are not cached
+        value = json.dumps([
+            {name: item for name, item in r.items() if name not in ('time', 'timings')} for r in result
+        ], ensure_ascii=False)
+        self.remember(key, value)
+
+        if self.folder:
+            self.save(key, value)
+
+    def remember(self, key, value):
+        if self.max_items <= 0:
+            return
+
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key + '.json')
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            with open(path, encoding='UTF-8') as f:
+                value = f.read()
+            # Modification time orders files for eviction
+            os.utime(path)
+            return value
+        except OSError:
+            return None
+
+    def save(self, key, value):
+        path = self.path(key)
+        data = value.encode('UTF-8')
+
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.exception(e)
+            return
+
+        with self.lock:
+            self.disk_size += len(data) - old_size
+            evict = self.disk_size > self.max_disk_size
+
+        if evict:
+            self.evict()
+
+    def get_disk_size(self):
+        return sum(os.path.getsize(path) for path, _ in self.get_files())
+
+    def get_files(self):
+        files = []
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    try:
+                        files.append((path, os.stat(path).st_mtime))
+                    except OSError:
+                        pass
+        return files
+
+    def evict(self):
+        # Several processes can share the folder, so its size is measured again before removing files
+        files = sorted(self.get_files(), key=lambda file: file[1])
+        sizes = {}
+        for path, _ in files:
+            try:
+                sizes[path] = os.path.getsize(path)
+            except OSError:
+                sizes[path] = 0
+
+        size, target = sum(sizes.values()), self.max_disk_size * 0.9
+        for path, _ in files:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= sizes[path]
+
+        with self.lock:
+            self.disk_size = size
@@ -1,12 +1,23 @@
 import numpy as np
+import logging
 import argparse
 import configparser
-from data_loader import preprocess
-from decoder import GreedyDecoder
+import threading
+import time
+from concurrent.futures import Future
+import metrics
+from data_loader import load_audio, preprocess, normalize, split_audio, get_inference_batch, StreamingPreprocessor
+from decoder import load_decoder, start_decode_pool, merge_results
+from device_buffers import InputBufferPool
+
+
+gpu_pool_size = metrics.gauge('asr_gpu_memory_pool_bytes', 'Size of the GPU memory pool after an acoustic model batch')
+gpu_pool_releases = metrics.counter('asr_gpu_memory_pool_releases_total',
+                                    'Times the GPU memory pool was returned to the driver to stay under the memory cap')
 
 
 class SpeechRecognizer(object):
-    def __init__(self, config_path='config.ini'):
+    def __init__(self, config_path='config.ini', decoder=None, decode_pool=None):
         if config_path is None:
             raise Exception('Path to config file is None')
         self.config = configparser.ConfigParser()
@@ -17,10 +28,32 @@ class SpeechRecognizer(object):
         self.window_stride = float(self.config['Wav2Letter']['window_stride'])
         self.greedy = int(self.config['Wav2Letter']['greedy'])
         self.cpu = int(self.config['Wav2Letter']['cpu'])
+        self.batch_size = int(self.config['Wav2Letter'].get('batch_size', 16))
+        self.bucket_ratio = float(self.config['Wav2Letter'].get('bucket_ratio', 1.5))
+        self.stream_window = float(self.config['Wav2Letter'].get('stream_window', 4.0))
+        self.stream_context = float(self.config['Wav2Letter'].get('stream_context', 1.0))
+        self.segment_length = float(self.config['Wav2Letter'].get('segment_length', 0))
+        self.segment_search = float(self.config['Wav2Letter'].get('segment_search', 5.0))
+        self.decode_processes = int(self.config['Wav2Letter'].get('decode_processes', 0))
+        self.decode_timeout = float(self.config['Wav2Letter'].get('decode_timeout', 120)) or None
+        self.memory_cap = int(float(self.config['Wav2Letter'].get('memory_cap', 0)) * 2 ** 20)
+        self.cpu_threads = int(self.config['Wav2Letter'].get('cpu_threads', 0))
+        self.shared_weights = self.config['Wav2Letter'].get('shared_weights', '')
+
+        # Decoder processes are forked before the acoustic model is loaded, so they do not share its backend state,
+        # servers fork the pool themselves before any of their threads. With a pool the decoder is built by its
+        # spawner and the pool stands in for it
+        self.decode_pool = decode_pool
+        if decoder is None and decode_pool is None:
+            self.decode_pool = start_decode_pool(self.config)
+        if decoder is None:
+            decoder = load_decoder(self.config) if self.decode_pool is None else self.decode_pool.start()
+        self.decoder = decoder
+        self.decoder_lock = threading.Lock()
 
         if self.cpu:
-            from PuzzleLib import Config
-            Config.backend = Config.Backend.cpu
+            from cpu_backend import setup_cpu_backend
+            setup_cpu_backend(self.cpu_threads)
 
         from PuzzleLib.Models.Nets.WaveToLetter import loadW2L
         from PuzzleLib.Modules import MoveAxis
@@ -28,43 +61,301 @@ class SpeechRecognizer(object):
         nfft = int(self.sample_rate * self.window_size)
         self.w2l = loadW2L(modelpath=self.config['Wav2Letter']['model_path'], inmaps=(1 + nfft // 2),
                            nlabels=len(self.labels))
+
+        if self.cpu and self.shared_weights:
+            from cpu_backend import share_weights
+            share_weights(self.w2l, self.config['Wav2Letter']['model_path'], self.shared_weights)
+
         self.w2l.append(MoveAxis(src=2, dst=0))
 
         if not self.cpu:
             self.w2l.calcMode(np.float16)
 
         self.w2l.evalMode()
-
-        if not self.greedy:
-            from decoder import TrieDecoder
-            lexicon = self.config['Wav2Letter']['lexicon']
-            tokens = self.config['Wav2Letter']['tokens']
-            lm_path = self.config['Wav2Letter']['lm_path']
-            beam_threshold = float(self.config['Wav2Letter']['beam_threshold'])
-            self.decoder = TrieDecoder(lexicon, tokens, lm_path, beam_threshold)
-        else:
-            self.decoder = GreedyDecoder(self.labels)
+        self.input_buffers = InputBufferPool(not self.cpu, self.memory_cap)
 
     def recognize(self, audio_path):
-        preprocessed_audio = preprocess(audio_path, self.sample_rate, self.window_size, self.window_stride)
-        if self.cpu:
-            from PuzzleLib.CPU.CPUArray import CPUArray
-            inputs = CPUArray.toDevice(np.array([preprocessed_audio]).astype(np.float32))
+        result = self.recognize_batch([audio_path])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def recognize_batch(self, audios, timings=None, forward=None):
+        # timings is an optional list with a dict per audio that receives the time of every stage,
+        # an audio that fails gets its exception in place of the result and does not fail the others.
+        # forward yields the outputs of the spectrograms as they are ready, see forward_buckets
+        forward = self.forward_buckets if forward is None else forward
+        timings = [None] * len(audios) if timings is None else timings
+        spectrograms, offsets, owners = [], [], []
+        errors = [None] * len(audios)
+
+        # Long audios are split into segments, segments of all audios are batched together
+        for i, (audio, audio_timings) in enumerate(zip(audios, timings)):
+            try:
+                with metrics.timed(metrics.stage_latency, audio_timings, stage='preprocess'):
+                    segments = [(offset, self.preprocess(segment)) for offset, segment in self.split(audio)]
+            except Exception as e:
+                logging.exception(e)
+                errors[i] = e
+                continue
+
+            for offset, spectrogram in segments:
+                spectrograms.append(spectrogram)
+                offsets.append(offset)
+                owners.append(i)
+
+        decodings = [None] * len(spectrograms)
+        start_times, end_times = {}, {}
+        submit_time = time.time()
+
+        # Every output is decoded as soon as it is ready, so that decoder processes work while the model runs
+        for j, output, start_time, end_time in forward(spectrograms):
+            i = owners[j]
+            spectrograms[j] = None
+
+            if isinstance(output, Exception):
+                errors[i] = output
+                continue
+
+            start_times[i] = min(start_times.get(i, start_time), start_time)
+            end_times[i] = max(end_times.get(i, end_time), end_time)
+            try:
+                decodings[j] = self.decode_async(output, offsets[j])
+            except Exception as e:
+                logging.exception(e)
+                errors[i] = e
+
+        results = []
+        for i, audio_timings in enumerate(timings):
+            if errors[i] is not None:
+                results.append(errors[i])
+                continue
+
+            try:
+                if audio_timings is not None:
+                    audio_timings['queue_wait'] = start_times[i] - submit_time
+                    audio_timings['acoustic_model'] = end_times[i] - start_times[i]
+
+                with metrics.timed(metrics.stage_latency, audio_timings, stage='decode'):
+                    results.append(merge_results([
+                        decoding.result(self.decode_timeout) for decoding, owner in zip(decodings, owners) if owner == i
+                    ]))
+            except Exception as e:
+                logging.exception(e)
+                results.append(e)
+
+        return results
+
+    def recognize_stream(self, chunks, forward=None):
+        stream = StreamingRecognizer(self, forward)
+
+        for chunk in chunks:
+            for result in stream.feed(chunk):
+                yield result
+
+        for result in stream.finish():
+            yield result
+
+    def preprocess(self, audio):
+        return preprocess(audio, self.sample_rate, self.window_size, self.window_stride)
+
+    def split(self, audio):
+        # Returns segments of the audio with their start times in seconds, short audio is kept whole
+        if self.segment_length <= 0:
+            return [(0.0, audio)]
+
+        if isinstance(audio, str):
+            audio = load_audio(audio, self.sample_rate)
         else:
-            from PuzzleLib.Backend import gpuarray
-            inputs = gpuarray.to_gpu(np.array([preprocessed_audio]).astype(np.float16))
+            audio = np.asarray(audio, dtype=np.float32)
+
+        if len(audio) <= (self.segment_length + self.segment_search) * self.sample_rate:
+            return [(0.0, audio)]
+
+        return [
+            (start / self.sample_rate, audio[start:end])
+            for start, end in split_audio(audio, self.sample_rate, self.segment_length, self.segment_search)
+        ]
+
+    def decode(self, output, start_timestamp=0, frame_time=0.02):
+        if self.decode_pool is not None:
+            return self.decode_pool.submit(output, start_timestamp, frame_time).result(self.decode_timeout)
+
+        with self.decoder_lock:
+            return self.decoder.decode(output, start_timestamp=start_timestamp, frame_time=frame_time)
+
+    def decode_async(self, output, start_timestamp=0, frame_time=0.02):
+        if self.decode_pool is not None:
+            return self.decode_pool.submit(output, start_timestamp, frame_time)
+
+        future = Future()
+        future.set_result(self.decode(output, start_timestamp, frame_time))
+        return future
+
+    def get_buckets(self, seq_lengths):
+        buckets, bucket = [], []
+
+        for idx in np.argsort(seq_lengths, kind='stable'):
+            if len(bucket) > 0 and (len(bucket) == self.batch_size or
+                                    seq_lengths[idx] > seq_lengths[bucket[0]] * self.bucket_ratio):
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(idx)
 
-        output = self.w2l(inputs).get()
-        output = np.vstack(output).astype(np.float32)
-        result = self.decoder.decode(output)
+        if len(bucket) > 0:
+            buckets.append(bucket)
+
+        return buckets
+
+    def forward_buckets(self, spectrograms):
+        # Yields the index, output and start and end time of the batch of every spectrogram, spectrograms of
+        # similar length are run together and an utterance that fails yields its exception in place of the output
+        for bucket in self.get_buckets([spectrogram.shape[1] for spectrogram in spectrograms]):
+            start_time = time.time()
+            outputs = self.forward_each([spectrograms[j] for j in bucket])
+            end_time = time.time()
+
+            for j, output in zip(bucket, outputs):
+                yield j, output, start_time, end_time
+
+    def forward_each(self, spectrograms):
+        # A failed batch is run again utterance by utterance, outputs of the utterances that still fail are
+        # replaced with their exceptions
+        try:
+            return self.forward(spectrograms)
+        except Exception as e:
+            if len(spectrograms) == 1:
+                return [e]
+            logging.exception(e)
+
+        return [self.forward_each([spectrogram])[0] for spectrogram in spectrograms]
+
+    def forward(self, spectrograms):
+        dtype = np.dtype(np.float32 if self.cpu else np.float16)
+        max_seq_length = max(spectrogram.shape[1] for spectrogram in spectrograms)
+        nbytes = dtype.itemsize * len(spectrograms) * spectrograms[0].shape[0] * max_seq_length
+        buffer = self.input_buffers.acquire(nbytes)
+
+        try:
+            with metrics.timed(metrics.stage_latency, stage='acoustic_model'):
+                batch, seq_lengths = get_inference_batch(spectrograms, dtype, buffer.host)
+                inputs = buffer.upload(batch)
+
+                output = self.w2l(inputs).get()
+                out_lengths = np.ceil(output.shape[0] * seq_lengths / batch.shape[2]).astype(int)
+                # Outputs are views of the batch output, decoders convert them to float32 in their own buffers
+                outputs = [output[:min(out_lengths[i], output.shape[0]), i] for i in range(len(spectrograms))]
+
+            del inputs, batch
+        finally:
+            self.input_buffers.release(buffer)
 
         if not self.cpu:
+            # Memory held by the pool is reused by the next batches and only returned to the driver above the cap
             from PuzzleLib.Backend.gpuarray import memoryPool
-            memoryPool.freeHeld()
+            pool_size = memoryPool.getStats()['poolSize']
+            if pool_size + self.input_buffers.size > self.memory_cap:
+                memoryPool.freeHeld()
+                gpu_pool_releases.inc()
+                pool_size = memoryPool.getStats()['poolSize']
+            gpu_pool_size.set(pool_size)
 
-        del inputs, output
+        return outputs
 
-        return result
+
+class StreamingRecognizer(object):
+    def __init__(self, recognizer, forward=None):
+        self.recognizer = recognizer
+        self.forward = recognizer.forward_buckets if forward is None else forward
+        self.preprocessor = StreamingPreprocessor(recognizer.sample_rate, recognizer.window_size,
+                                                  recognizer.window_stride)
+        # W2L halves the frame rate, so windows are kept aligned to an even number of feature frames
+        self.frame_time = 2 * recognizer.window_stride
+        self.window_frames = max(2, int(recognizer.stream_window / recognizer.window_stride) // 2 * 2)
+        self.context_frames = int(recognizer.stream_context / recognizer.window_stride) // 2 * 2
+
+        self.features = np.zeros((self.preprocessor.freq_size, 0))
+        self.features_offset, self.emitted = 0, 0
+        self.posteriors, self.posteriors_offset = None, 0
+        self.leftover = b''
+
+    def feed(self, audio):
+        if isinstance(audio, (bytes, bytearray)):
+            audio = self.leftover + bytes(audio)
+            cut = len(audio) - len(audio) % 2
+            audio, self.leftover = np.frombuffer(audio[:cut], dtype=np.int16), audio[cut:]
+
+        return self.process(self.preprocessor.push(audio), final=False)
+
+    def finish(self):
+        return self.process(self.preprocessor.push(np.zeros(0), final=True), final=True)
+
+    def process(self, features, final):
+        self.features = np.hstack([self.features, features])
+        end = self.features_offset + self.features.shape[1]
+        results = []
+
+        while self.emitted < end and (final or self.emitted + self.window_frames + self.context_frames <= end):
+            start = max(self.features_offset, self.emitted - self.context_frames)
+            stop = min(end, self.emitted + self.window_frames + self.context_frames)
+            window = self.features[:, start - self.features_offset:stop - self.features_offset]
+            _, output, _, _ = next(self.forward([normalize(window.astype(np.float32))]))
+            if isinstance(output, Exception):
+                raise output
+
+            first = (self.emitted - start) // 2
+            last = first + (min(end, self.emitted + self.window_frames) - self.emitted + 1) // 2
+            self.append_posteriors(output[first:last])
+
+            self.emitted += self.window_frames
+            drop = max(0, self.emitted - self.context_frames - self.features_offset)
+            self.features = self.features[:, drop:]
+            self.features_offset += drop
+
+            results.extend(self.decode(final=False))
+
+        if final:
+            results.extend(self.decode(final=True))
+
+        return results
+
+    def append_posteriors(self, output):
+        if self.posteriors is None:
+            self.posteriors = output
+        else:
+            self.posteriors = np.vstack([self.posteriors, output])
+
+    def decode(self, final):
+        if self.posteriors is None or self.posteriors.shape[0] == 0:
+            return []
+
+        start_timestamp = self.posteriors_offset * self.frame_time
+        result = self.recognizer.decode(self.posteriors, start_timestamp=start_timestamp, frame_time=self.frame_time)
+
+        if final:
+            self.posteriors = None
+            return [result] if len(result.words) > 0 else []
+
+        if len(result.words) == 0:
+            self.drop_posteriors(self.skip_silence(0))
+            return []
+
+        # Only complete words are emitted, the tail is decoded again together with the next window
+        end_frame = int(round((result.words[-1]["end"] - start_timestamp) / self.frame_time))
+        self.drop_posteriors(self.skip_silence(end_frame))
+
+        return [result]
+
+    def skip_silence(self, idx):
+        decoder = self.recognizer.decoder
+        best_path = np.argmax(self.posteriors[idx:], axis=1)
+        voiced = np.flatnonzero((best_path != decoder.blank_idx) & (best_path != decoder.delim_idx))
+
+        return idx + voiced[0] if len(voiced) > 0 else self.posteriors.shape[0]
+
+    def drop_posteriors(self, cut):
+        self.posteriors = self.posteriors[cut:]
+        self.posteriors_offset += cut
 
 
 def test():
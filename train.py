@@ -6,6 +6,7 @@ import configparser
 import Levenshtein
 from data_loader import DataLoader, SpectrogramDataset, BucketingSampler
 from decoder import GreedyDecoder
+from feature_store import get_feature_store, get_store_folder
 from PuzzleLib.Models.Nets.WaveToLetter import loadW2L
 from PuzzleLib.Backend import gpuarray
 from PuzzleLib.Cost.CTC import CTC
@@ -14,8 +15,14 @@ from PuzzleLib.Modules import MoveAxis
 from PuzzleLib.Modules.Cast import Cast
 
 
-def get_data_loader(manifest_file_path, labels, sample_rate, window_size, window_stride, batch_size):
-    dataset = SpectrogramDataset(labels, sample_rate, window_size, window_stride, manifest_file_path)
+def get_data_loader(manifest_file_path, labels, sample_rate, window_size, window_stride, batch_size,
+                    feature_cache='', feature_dtype='float32', feature_shard_size=1 << 30):
+    feature_store = None
+    if feature_cache:
+        feature_store = get_feature_store(manifest_file_path, get_store_folder(feature_cache, manifest_file_path),
+                                          sample_rate, window_size, window_stride, feature_dtype, feature_shard_size)
+
+    dataset = SpectrogramDataset(labels, sample_rate, window_size, window_stride, manifest_file_path, feature_store)
     sampler = BucketingSampler(dataset, batch_size=batch_size)
     return DataLoader(dataset, batch_sampler=sampler)
 
@@ -88,9 +95,7 @@ def validate(model, loader, decoder, fp16):
         out = model(inputs)
         out_len = (out.shape[0] * input_percentages).astype(np.int32)
 
-        decoded_output = [
-            decoder.decode(output, max_len=out_len[j]) for j, output in enumerate(np.moveaxis(out.get(), 0, 1))
-        ]
+        decoded_output = [result.text for result in decoder.decode(np.moveaxis(out.get(), 0, 1), max_len=out_len)]
 
         print('\nValidation iter {} of {}'.format(i + 1, len(loader)))
 
@@ -138,14 +143,19 @@ def main():
     checkpoint_per_batch = int(config['Train'].get('checkpoint_per_batch'))
     save_folder = config['Train'].get('save_folder')
     continue_from = config['Train'].get('continue_from')
+    feature_cache = config['Train'].get('feature_cache', '')
+    feature_dtype = config['Train'].get('feature_dtype', 'float32')
+    feature_shard_size = int(float(config['Train'].get('feature_shard_size', 1024)) * 2 ** 20)
 
     train_loader, val_loader = None, None
 
     if train_manifest is not None:
-        train_loader = get_data_loader(train_manifest, labels, sample_rate, window_size, window_stride, batch_size)
+        train_loader = get_data_loader(train_manifest, labels, sample_rate, window_size, window_stride, batch_size,
+                                       feature_cache, feature_dtype, feature_shard_size)
 
     if val_manifest is not None:
-        val_loader = get_data_loader(val_manifest, labels, sample_rate, window_size, window_stride, batch_size)
+        val_loader = get_data_loader(val_manifest, labels, sample_rate, window_size, window_stride, batch_size,
+                                     feature_cache, feature_dtype, feature_shard_size)
 
     nfft = int(sample_rate * window_size)
     w2l = loadW2L(modelpath=continue_from, inmaps=(1 + nfft // 2), nlabels=len(labels))
@@ -1,6 +1,7 @@
 from scipy import signal
 import numpy as np
 import scipy
+import scipy.fft
 from numpy import fft
 from numpy.lib.stride_tricks import as_strided
 
@@ -123,6 +124,35 @@ def stft(y, n_fft=2048, hop_length=None, win_length=None, window='hann',
     return stft_matrix
 
 
+def stft_magnitude(y, n_fft=2048, hop_length=None, win_length=None, window='hann',
+                   center=True, dtype=np.float32, pad_mode='reflect'):
+    if win_length is None:
+        win_length = n_fft
+
+    if hop_length is None:
+        hop_length = int(win_length // 4)
+
+    fft_window = pad_center(get_window(window, win_length, fftbins=True), n_fft)
+    fft_window = fft_window.reshape((-1, 1)).astype(dtype)
+
+    y = np.asarray(y, dtype=dtype)
+    if center:
+        y = np.pad(y, int(n_fft // 2), mode=pad_mode)
+
+    y_frames = frame(y, frame_length=n_fft, hop_length=hop_length)
+
+    # Magnitudes are written straight into the output, only the rfft half-spectrum is computed
+    mag_matrix = np.empty((int(1 + n_fft // 2), y_frames.shape[1]), dtype=dtype, order='F')
+
+    n_columns = max(1, int(MAX_MEM_BLOCK / (mag_matrix.shape[0] * mag_matrix.itemsize * 2)))
+
+    for bl_s in range(0, mag_matrix.shape[1], n_columns):
+        bl_t = min(bl_s + n_columns, mag_matrix.shape[1])
+        np.abs(scipy.fft.rfft(fft_window * y_frames[:, bl_s:bl_t], axis=0), out=mag_matrix[:, bl_s:bl_t])
+
+    return mag_matrix
+
+
 def magphase(d, power=1):
     mag = np.abs(d)
     mag **= power